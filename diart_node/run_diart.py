@@ -4,6 +4,7 @@ from diart.inference import StreamingInference
 
 from custom_observers import StdoutWriter
 from custom_sources import TCPAudioSource
+from live_profiler import LiveProfiler
 
 
 def main(sample_rate: int, chunk_duration: float, host: str, port: int) -> None:
@@ -69,6 +70,22 @@ if __name__ == '__main__':
         help='Port number that DIART listens to for incoming audio'
     )
 
+    parser.add_argument(
+        '--profile-dir',
+        type=str,
+        default='.',
+        help='Directory of the profiles captured on SIGUSR1 (kill -USR1 <pid>) from the live process'
+    )
+    parser.add_argument(
+        '--profile-seconds',
+        type=float,
+        default=20,
+        help='Length of a live profile capture in seconds'
+    )
+
     # Parse CLI arguments and pass them to the main function
     args = parser.parse_args()
+
+    # Capture a profile of the running node on SIGUSR1
+    LiveProfiler(args.profile_dir, args.profile_seconds).install()
     main(args.sample_rate, args.chunk_duration, args.host, args.port)
@@ -1,5 +1,6 @@
 import argparse
 from diarization_merger import DiarizationMerger
+from live_profiler import LiveProfiler
 
 
 def main(transcription_port: int, diarization_port: int, diarization_buffer_size: int, maximum_diarization_delay: float) -> None:
@@ -57,8 +58,24 @@ if __name__ == '__main__':
         help='Maximum delay (in seconds) to wait for diarization results.'
     )
 
+    parser.add_argument(
+        '--profile-dir',
+        type=str,
+        default='.',
+        help='Directory of the profiles captured on SIGUSR1 (kill -USR1 <pid>) from the live process.'
+    )
+    parser.add_argument(
+        '--profile-seconds',
+        type=float,
+        default=20,
+        help='Length of a live profile capture in seconds.'
+    )
+
     # Parse CLI arguments and invoke main function
     args = parser.parse_args()
+
+    # Capture a profile of the running node on SIGUSR1
+    LiveProfiler(args.profile_dir, args.profile_seconds).install()
     main(
         args.transcription_port,
         args.diarization_port,
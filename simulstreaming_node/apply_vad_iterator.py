@@ -1,6 +1,7 @@
 # for debugging only
 
 from whisper_streaming.whisper_online_main import load_audio_chunk, load_audio
+from whisper_streaming.vad_backends import VAD_BACKENDS, load_vad_model
 
 import argparse
 import sys
@@ -10,6 +11,10 @@ parser = argparse.ArgumentParser()
 parser.add_argument('--vac-chunk-size', type=float, default=0.04, 
                     help='VAC sample size in seconds.')
 parser.add_argument('audio_path', type=str, help="Filename of 16kHz mono channel wav, on which live streaming is simulated.")
+parser.add_argument('--vac-backend', type=str, default="silero", choices=list(VAD_BACKENDS),
+                    help='VAD model, see --vac-backend of simulstreaming_whisper.py.')
+parser.add_argument('--vac-model-path', type=str, default=None,
+                    help='Path to a local VAD model file for --vac-backend.')
 parser.add_argument('--start_at', type=float, default=0.0, help='Start processing audio at this time.')
 
 
@@ -20,11 +25,7 @@ SAMPLING_RATE = 16000
 duration = len(load_audio(args.audio_path))/SAMPLING_RATE
 
 from whisper_streaming.silero_vad_iterator import FixedVADIterator
-import torch
-model, _ = torch.hub.load(
-    repo_or_dir='snakers4/silero-vad',
-    model='silero_vad'
-)
+model = load_vad_model(args.vac_backend, args.vac_model_path)
 vac = FixedVADIterator(model)
 
 
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+# Startup benchmark of simulstreaming_whisper_server.py: the time from launching the server process to the first
+# accepted client connection, and when the milestones of the startup were logged.
+# The first run is usually slower than the next ones, because the files are not in the page cache yet, and the
+# tokenizer vocabulary and the compiled graphs (with --compile_cache_dir) are not cached yet.
+#
+# All the arguments after -- are passed to the server. Example:
+#   python3 benchmark_startup.py --runs 3 -- --model_path large-v3.pt --warmup-file jfk.wav --port 43099
+
+import os
+import sys
+import time
+import socket
+import logging
+import argparse
+import threading
+import subprocess
+
+logger = logging.getLogger(__name__)
+
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "simulstreaming_whisper_server.py")
+
+# substrings of the server log lines, in the order of the startup
+MILESTONES = [
+    ("model loaded", "Model dimensions"),
+    ("warmed up", "Whisper is warmed up"),
+    ("listening", "Listening on"),
+    ("accepted", "Connected to client"),
+]
+
+
+def run(server_args, host, port, timeout):
+    '''Starts the server, connects to it and returns the dict of the milestone times in seconds from the start.'''
+    start = time.time()
+    proc = subprocess.Popen([sys.executable, SERVER, "--host", host, "--port", str(port), "-l", "INFO"] + server_args,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    times = {}
+    accepted = threading.Event()
+
+    def read_log():
+        for line in proc.stderr:
+            for name, marker in MILESTONES:
+                if marker in line and name not in times:
+                    times[name] = time.time() - start
+                    if name == "accepted":
+                        accepted.set()
+            logger.debug(line.rstrip())
+
+    reader = threading.Thread(target=read_log, daemon=True)
+    reader.start()
+    try:
+        while True:
+            if proc.poll() is not None:
+                raise RuntimeError(f"The server terminated with code {proc.returncode} before accepting a connection.")
+            if time.time() - start > timeout:
+                raise RuntimeError(f"The server did not accept a connection in {timeout} seconds.")
+            try:
+                conn = socket.create_connection((host, port), timeout=1)
+                break
+            except OSError:
+                time.sleep(0.01)
+        times["connected"] = time.time() - start
+        accepted.wait(timeout)
+        conn.close()
+    finally:
+        proc.terminate()
+        proc.wait()
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measures the startup time of the SimulStreaming server.")
+    parser.add_argument("--runs", type=int, default=3, help="Number of server starts.")
+    parser.add_argument("--host", type=str, default="localhost")
+    parser.add_argument("--port", type=int, default=43099)
+    parser.add_argument("--timeout", type=float, default=600, help="Maximum startup time in seconds.")
+    parser.add_argument("-l", "--log-level", dest="log_level", default="INFO",
+                        choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'],
+                        help="DEBUG shows the log of the server.")
+    parser.add_argument("server_args", nargs=argparse.REMAINDER, help="Arguments of the server, after --.")
+    args = parser.parse_args()
+    logging.basicConfig(format='%(levelname)s\t%(message)s', level=args.log_level)
+    server_args = args.server_args[1:] if args.server_args[:1] == ["--"] else args.server_args
+
+    names = [name for name, _ in MILESTONES] + ["connected"]
+    print("run\t" + "\t".join(names))
+    for i in range(args.runs):
+        times = run(server_args, args.host, args.port, args.timeout)
+        print(f"{i}\t" + "\t".join(f"{times[n]:.3f}" if n in times else "-" for n in names), flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+
+# Benchmark of the VAC overhead per audio chunk: FixedVADIterator alone, and VACOnlineASRProcessor.insert_audio_chunk
+# with process_iter around an online processor that does nothing, so that Whisper is not measured.
+# With --sessions N, N concurrent sessions process the audio in threads, with their own models or with one BatchedVAD
+# (--vac-batched), and the CPU time per session is reported.
+#
+# Example:
+#   python3 benchmark_vad.py audio.wav --vac-backend silero --vac-model-path silero_vad.jit --vac-chunk-size 0.04
+#   python3 benchmark_vad.py audio.wav --vac-backend silero --vac-model-path silero_vad.jit --sessions 32 --vac-batched
+
+import time
+import logging
+import threading
+import argparse
+
+import numpy as np
+
+from whisper_streaming.base import OnlineProcessorInterface
+from whisper_streaming.silero_vad_iterator import FixedVADIterator
+from whisper_streaming.vac_online_processor import VACOnlineASRProcessor
+from whisper_streaming.vad_backends import VAD_BACKENDS, load_vad_model
+from whisper_streaming.batched_vad import BatchedVAD
+from whisper_streaming.whisper_online_main import load_audio
+
+logger = logging.getLogger(__name__)
+
+SAMPLING_RATE = 16000
+
+
+class NoOnline(OnlineProcessorInterface):
+    '''Online processor that only receives the audio.'''
+
+    def init(self, offset=None):
+        pass
+
+    def insert_audio_chunk(self, audio):
+        pass
+
+    def process_iter(self):
+        return (None, None, "")
+
+    def finish(self):
+        return (None, None, "")
+
+
+def measure(step, audio, chunk, repeat):
+    '''Returns the processing times of every chunk in microseconds, of all repetitions.'''
+    times = []
+    for _ in range(repeat):
+        for beg in range(0, len(audio), chunk):
+            x = audio[beg:beg + chunk]
+            start = time.perf_counter()
+            step(x)
+            times.append((time.perf_counter() - start) * 1e6)
+    return np.array(times)
+
+
+def measure_sessions(args, audio, chunk):
+    '''Runs args.sessions concurrent sessions in threads, in real time: every session gets the next chunk every chunk
+    duration. Returns the CPU time of the process per session and per second of audio, in microseconds, and the
+    batches of BatchedVAD.'''
+    if args.vac_batched:
+        service = BatchedVAD(load_vad_model(args.vac_backend, args.vac_model_path))
+        vads = [FixedVADIterator(service.session()) for _ in range(args.sessions)]
+    else:
+        service = None
+        vads = [FixedVADIterator(load_vad_model(args.vac_backend, args.vac_model_path)) for _ in range(args.sessions)]
+    chunk_time = chunk / SAMPLING_RATE
+    start = time.time() + 0.1
+
+    def stream(vad):
+        for i, beg in enumerate(range(0, len(audio), chunk)):
+            delay = start + i * chunk_time - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            vad(audio[beg:beg + chunk])
+
+    threads = [threading.Thread(target=stream, args=(vad,)) for vad in vads]
+    cpu = time.process_time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    cpu = time.process_time() - cpu
+    cpu_per_second = cpu / args.sessions / (len(audio) / SAMPLING_RATE) * 1e6
+    return cpu_per_second, service
+
+
+def report(name, times, chunk):
+    chunk_us = chunk / SAMPLING_RATE * 1e6
+    print(f"{name}\t{times.mean():.1f}\t{np.percentile(times, 50):.1f}\t{np.percentile(times, 99):.1f}\t"
+          f"{times.mean() / chunk_us * 100:.3f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measures the VAC overhead per audio chunk.")
+    parser.add_argument("audio_path", type=str, help="Filename of 16kHz mono channel wav.")
+    parser.add_argument('--vac-chunk-size', type=float, default=0.04, help='VAC sample size in seconds.')
+    parser.add_argument('--vac-backend', type=str, default="silero", choices=list(VAD_BACKENDS))
+    parser.add_argument('--vac-model-path', type=str, default=None)
+    parser.add_argument("--repeat", type=int, default=3, help="How many times the audio is processed.")
+    parser.add_argument("--sessions", type=int, default=None,
+                        help="Number of concurrent sessions in real time. If not set, one session as fast as possible.")
+    parser.add_argument('--vac-batched', action="store_true", default=False,
+                        help="With --sessions, evaluate the VAD of all sessions in batches.")
+    args = parser.parse_args()
+    logging.basicConfig(format='%(levelname)s\t%(message)s', level=logging.WARNING)
+
+    audio = load_audio(args.audio_path)
+    chunk = int(args.vac_chunk_size * SAMPLING_RATE)
+
+    if args.sessions is not None:
+        cpu_per_second, service = measure_sessions(args, audio, chunk)
+        print(f"sessions\t{args.sessions}\nCPU us per session and audio second\t{cpu_per_second:.1f}")
+        if service is not None:
+            print(f"mean batch size\t{service.windows / max(service.batches, 1):.1f}")
+        return
+
+    vad = FixedVADIterator(load_vad_model(args.vac_backend, args.vac_model_path))
+    vad_times = measure(vad, audio, chunk, args.repeat)
+
+    # the online chunk size doesn't matter, the online processor does nothing
+    vac = VACOnlineASRProcessor(1.0, NoOnline(), vad_backend=args.vac_backend, vad_model_path=args.vac_model_path)
+
+    def vac_step(x):
+        vac.insert_audio_chunk(x)
+        vac.process_iter()
+    vac_times = measure(vac_step, audio, chunk, args.repeat)
+
+    print("\tmean_us\tp50_us\tp99_us\t%_of_real_time")
+    report("vad", vad_times, chunk)
+    report("vac", vac_times, chunk)
+
+
+if __name__ == "__main__":
+    main()
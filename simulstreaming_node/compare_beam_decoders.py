@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+
+# Checks that VectorizedBeamSearchDecoder selects the same hypotheses as BeamSearchDecoder of Whisper: the same tokens,
+# sum_logprobs, KV cache rearrangements and finished sequences after every update. Both decoders are run on the same
+# sequences of random logits, with identical start tokens (as at the first step of a segment), with more audios in
+# a batch, and with a strong EOT logit, so that the merging of duplicate prefixes and the handling of the finished
+# sequences are exercised. It exits with code 1 on the first difference.
+#
+# Example:
+#   python3 compare_beam_decoders.py --trials 200 --beam-sizes 2 4 5
+
+import sys
+import logging
+import argparse
+
+import torch
+
+from simul_whisper.whisper.decoding import BeamSearchDecoder
+from simul_whisper.beam import VectorizedBeamSearchDecoder
+
+logger = logging.getLogger(__name__)
+
+
+class RecordingInference:
+    '''Records the source indices of rearrange_kv_cache, instead of rearranging a KV cache.'''
+
+    def __init__(self):
+        self.source_indices = []
+
+    def rearrange_kv_cache(self, source_indices):
+        if isinstance(source_indices, torch.Tensor):
+            source_indices = source_indices.tolist()
+        self.source_indices.append(list(source_indices))
+
+
+def compare(trial, beam_size, n_audio, steps, vocab, eot_bias, generator):
+    '''Runs both decoders for the steps, returns the description of the first difference, or None.'''
+    eot = vocab - 1
+    start = torch.randint(0, eot, (n_audio, 3), generator=generator)
+    tokens = start.repeat_interleave(beam_size, dim=0)
+    decoders = []
+    for cls in (BeamSearchDecoder, VectorizedBeamSearchDecoder):
+        inference = RecordingInference()
+        decoders.append((cls(beam_size=beam_size, eot=eot, inference=inference), inference,
+                         tokens.clone(), torch.zeros(n_audio * beam_size)))
+
+    for step in range(steps):
+        logits = torch.randn(n_audio * beam_size, vocab, generator=generator) * 3
+        logits[:, eot] += eot_bias
+        results = []
+        for decoder, inference, tokens, sum_logprobs in decoders:
+            tokens, completed = decoder.update(tokens, logits.clone(), sum_logprobs)
+            # in the order of insertion, which is the order of the hypotheses in finalize()
+            finished = [list(sequences.items()) for sequences in decoder.finished_sequences]
+            results.append((tokens, completed, sum_logprobs.clone(), inference.source_indices[-1], finished))
+        (t1, c1, s1, i1, f1), (t2, c2, s2, i2, f2) = results
+        where = f"trial {trial}, beam size {beam_size}, {n_audio} audios, step {step}"
+        if not torch.equal(t1, t2):
+            return f"{where}: tokens differ\n{t1}\n{t2}"
+        if not torch.equal(s1, s2):
+            return f"{where}: sum_logprobs differ\n{s1}\n{s2}"
+        if i1 != i2:
+            return f"{where}: source indices differ: {i1} != {i2}"
+        if f1 != f2:
+            return f"{where}: finished sequences differ\n{f1}\n{f2}"
+        if c1 != c2:
+            return f"{where}: completed differs: {c1} != {c2}"
+        if c1:
+            break
+        decoders = [(d, inf, t, s) for (d, inf, _, s), (t, *_) in zip(decoders, results)]
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compares VectorizedBeamSearchDecoder with BeamSearchDecoder.")
+    parser.add_argument("--trials", type=int, default=100, help="Number of random logits sequences per beam size.")
+    parser.add_argument("--beam-sizes", type=int, nargs="+", default=[2, 3, 5])
+    parser.add_argument("--audios", type=int, nargs="+", default=[1, 2], help="Numbers of audios in a batch.")
+    parser.add_argument("--steps", type=int, default=30, help="Max number of decoder updates per trial.")
+    parser.add_argument("--vocab", type=int, default=50, help="Vocabulary size. Small, so that the hypotheses collide.")
+    parser.add_argument("--eot-bias", type=float, default=2.0, help="Added to the EOT logit, so that sequences finish.")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    generator = torch.Generator().manual_seed(args.seed)
+    n = 0
+    for beam_size in args.beam_sizes:
+        for n_audio in args.audios:
+            for trial in range(args.trials):
+                difference = compare(trial, beam_size, n_audio, args.steps, args.vocab, args.eot_bias, generator)
+                if difference is not None:
+                    logger.error(difference)
+                    sys.exit(1)
+                n += 1
+    logger.info(f"The decoders selected the same hypotheses in all {n} trials.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+
+# Compares the --precision modes of SimulStreaming on one audio file: WER, timing drift and real-time factor.
+# The streaming is simulated computationally unaware, in chunks of --min-chunk-size.
+#
+# Example:
+#   python3 compare_precision.py audio.wav --reference audio.txt --model_path small.pt --lan en --precisions fp32 int8-dynamic
+
+import time
+import difflib
+import logging
+import argparse
+
+from simulstreaming_whisper import simulwhisper_args, simul_asr_factory
+from simul_whisper.precision import PRECISIONS
+from whisper_streaming.whisper_online_main import processor_args, asr_factory, set_logging, load_audio, load_audio_chunk, \
+    indexed_vac_processor
+
+logger = logging.getLogger(__name__)
+
+SAMPLING_RATE = 16000
+
+
+def run(args, precision):
+    '''Returns the list of (beg, end, text) outputs and the processing time in seconds.'''
+    args.precision = precision
+    asr, online = asr_factory(args, simul_asr_factory)
+    if args.vad_index is not None:
+        online = indexed_vac_processor(args, online)
+    audio = load_audio(args.audio_path)
+    duration = len(audio) / SAMPLING_RATE
+    asr.warmup(load_audio_chunk(args.audio_path, 0, 1))
+    online.init()
+
+    outputs = []
+    processing = 0
+    beg = 0
+    while beg < duration:
+        end = min(beg + args.min_chunk_size, duration)
+        online.insert_audio_chunk(load_audio_chunk(args.audio_path, beg, end))
+        start = time.time()
+        o = online.process_iter()
+        processing += time.time() - start
+        if o[0] is not None:
+            outputs.append(o)
+        beg = end
+    start = time.time()
+    o = online.finish()
+    processing += time.time() - start
+    if o[0] is not None:
+        outputs.append(o)
+    return outputs, processing
+
+
+def words_with_times(outputs):
+    '''Every word with the beginning of the output that contains it.'''
+    return [(w, beg) for beg, _, text in outputs for w in text.split()]
+
+
+def wer(reference, hypothesis):
+    '''Word error rate of two lists of words, by the Levenshtein distance.'''
+    if not reference:
+        return float(len(hypothesis) > 0)
+    prev = list(range(len(hypothesis) + 1))
+    for i, r in enumerate(reference, 1):
+        cur = [i]
+        for j, h in enumerate(hypothesis, 1):
+            cur.append(min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + (r != h)))
+        prev = cur
+    return prev[-1] / len(reference)
+
+
+def timing_drift(base, other):
+    '''Mean and max absolute difference of the emission times of the words that are the same in both outputs.'''
+    matcher = difflib.SequenceMatcher(a=[w for w, _ in base], b=[w for w, _ in other], autojunk=False)
+    diffs = []
+    for block in matcher.get_matching_blocks():
+        for k in range(block.size):
+            diffs.append(abs(base[block.a + k][1] - other[block.b + k][1]))
+    if not diffs:
+        return None, None
+    return sum(diffs) / len(diffs), max(diffs)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    processor_args(parser)
+    simulwhisper_args(parser)
+    parser.add_argument("audio_path", type=str, help="Filename of 16kHz mono channel wav.")
+    parser.add_argument("--reference", type=str, default=None,
+                        help="Reference transcript for WER. If not set, the WER is computed against the output of the first precision.")
+    parser.add_argument("--vad-index", type=str, default=None,
+                        help="VAD index of the audio made by vad_indexer.py, or auto. Only the speech segments are processed.")
+    parser.add_argument("--precisions", nargs="+", default=PRECISIONS, choices=PRECISIONS,
+                        help="Precisions to compare. The timing drift is measured against the first one.")
+    args = parser.parse_args()
+    set_logging(args, logger)
+
+    duration = len(load_audio(args.audio_path)) / SAMPLING_RATE
+    reference = open(args.reference).read().split() if args.reference is not None else None
+
+    results = {}
+    for precision in args.precisions:
+        logger.info(f"Running precision {precision}")
+        outputs, processing = run(args, precision)
+        results[precision] = (words_with_times(outputs), processing)
+
+    base_words = results[args.precisions[0]][0]
+    print("precision\tWER\tmean_drift\tmax_drift\tRTF")
+    for precision in args.precisions:
+        words, processing = results[precision]
+        ref = reference if reference is not None else [w for w, _ in base_words]
+        mean_drift, max_drift = timing_drift(base_words, words)
+        print(f"{precision}\t{wer(ref, [w for w, _ in words]):.4f}\t"
+              f"{'-' if mean_drift is None else f'{mean_drift:.3f}'}\t"
+              f"{'-' if max_drift is None else f'{max_drift:.3f}'}\t"
+              f"{processing / duration:.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+import numpy as np
+import torch
+from collections import deque
+
+# audio buffer of PaddedAlignAttWhisper
+
+class SegmentAudioBuffer:
+    '''Audio buffer that is a sequence of segments, stored in one preallocated float32 tensor.
+
+    The segments are appended at the end and evicted from the beginning. The live audio is always
+    a contiguous slice of the tensor, so the mel front-end gets a view without concatenation.
+    When the end of the tensor is reached, the live audio is moved to its beginning. The capacity is
+    twice the max length, so it happens once per at least max_len seconds of appended audio, and
+    appending is amortized O(1). If a segment does not fit, the tensor is reallocated.
+
+    The lengths of the segments are kept because PaddedAlignAttWhisper evicts whole segments,
+    together with the tokens that were generated for them.
+    '''
+
+    def __init__(self, max_len: float, sampling_rate: int = 16000):
+        self.sampling_rate = sampling_rate
+        self.buffer = torch.zeros(2 * int(max_len * sampling_rate), dtype=torch.float32)
+        self.start = 0
+        self.end = 0
+        self.segment_lens = deque()
+        self.version = 0  # it changes whenever the audio changes
+        self.evicted = 0  # number of samples evicted since the start, for positions that survive eviction
+
+    def __len__(self):
+        '''number of segments'''
+        return len(self.segment_lens)
+
+    def num_samples(self):
+        return self.end - self.start
+
+    def seconds(self):
+        return self.num_samples() / self.sampling_rate
+
+    def _reserve(self, n):
+        if self.end + n <= len(self.buffer):
+            return
+        live = self.num_samples()
+        if live + n > len(self.buffer):
+            new = torch.zeros(2 * (live + n), dtype=torch.float32)
+            new[:live] = self.buffer[self.start:self.end]
+            self.buffer = new
+        else:
+            # the regions may overlap
+            self.buffer[:live] = self.buffer[self.start:self.end].clone()
+        self.start, self.end = 0, live
+
+    def append(self, segment):
+        '''segment: 1D torch.Tensor or np.ndarray, or a list of them that make one segment together'''
+        chunks = segment if isinstance(segment, (list, tuple)) else [segment]
+        chunks = [torch.from_numpy(c) if isinstance(c, np.ndarray) else c for c in chunks]
+        n = sum(c.shape[0] for c in chunks)
+        self._reserve(n)
+        for c in chunks:
+            self.buffer[self.end:self.end + c.shape[0]] = c
+            self.end += c.shape[0]
+        self.segment_lens.append(n)
+        self.version += 1
+
+    def pop_first(self):
+        '''evicts the first segment, returns its length in samples'''
+        n = self.segment_lens.popleft()
+        self.start += n
+        self.evicted += n
+        self.version += 1
+        return n
+
+    def trim_front(self, num_samples):
+        '''evicts the first num_samples samples, the first remaining segment may be shortened'''
+        num_samples = min(num_samples, self.num_samples())
+        while self.segment_lens and self.segment_lens[0] <= num_samples:
+            num_samples -= self.pop_first()
+        if num_samples > 0:
+            self.segment_lens[0] -= num_samples
+            self.start += num_samples
+            self.evicted += num_samples
+            self.version += 1
+
+    def keep_last(self, num):
+        '''evicts all segments except the last num ones'''
+        while len(self.segment_lens) > num:
+            self.pop_first()
+
+    def clear(self):
+        self.segment_lens.clear()
+        self.evicted += self.num_samples()
+        self.start = self.end = 0
+        self.version += 1
+
+    def last_segment(self):
+        return self.buffer[self.end - self.segment_lens[-1]:self.end]
+
+    def audio(self):
+        '''contiguous view of all the audio in the buffer. It is valid until the next append.'''
+        return self.buffer[self.start:self.end]
@@ -0,0 +1,201 @@
+import time
+import logging
+import threading
+
+import torch
+
+from whisper_streaming import metrics
+
+logger = logging.getLogger(__name__)
+
+# Continuous batching of the forward passes of many PaddedAlignAttWhisper sessions that share one model, e.g. the
+# concurrent connections of the server.
+#
+# The decoding of a session is the generator PaddedAlignAttWhisper.decode(), which yields its forward passes instead
+# of running them. The scheduler advances the generators of all sessions that are due for an update, one round at
+# a time: the encoder inputs of the round are stacked into one AudioEncoder call, and the single-token decoder steps
+# run together, with the KV cache of every session. Each session applies its own AlignAtt policy to its logits and
+# attention, and when its decoding stops, it leaves the batch and the others continue. New sessions join the batch
+# at the next round.
+#
+# At batch size 1, a step multiplies the weights by one vector, so its cost is mostly reading the weights. In a batch,
+# the Linear layers and the projection to the vocabulary read the weights once for all sessions. The attention has
+# no weights, it is computed for every session separately, over its own KV cache.
+
+
+class _Job:
+    def __init__(self, session, is_last):
+        self.session = session
+        self.steps = session.decode(is_last)
+        self.submitted = time.monotonic()
+        self.request = None
+        self.reply = None
+        self.finished = False
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+    def deadline(self):
+        '''The time of the oldest audio that the session has not decoded yet. The oldest one goes first.'''
+        if self.session.pending_since is not None:
+            return self.session.pending_since
+        return self.submitted
+
+
+class BatchScheduler:
+    '''Runs the decoding of the sessions of a SharedWhisperModel in a worker thread, in batches of up to max_batch
+    sessions.'''
+
+    def __init__(self, shared, max_batch):
+        self.shared = shared
+        self.max_batch = max_batch
+        self.condition = threading.Condition()
+        self.waiting = []
+        # statistics: forward passes and the sessions in them
+        self.encoder_batches = 0
+        self.encoded = 0
+        self.decoder_batches = 0
+        self.decoded = 0
+
+        self.worker = threading.Thread(target=self.run, daemon=True, name="BatchScheduler")
+        self.worker.start()
+
+    def infer(self, session, is_last):
+        '''PaddedAlignAttWhisper.infer of the session. It blocks until its decoding is finished.'''
+        job = _Job(session, is_last)
+        with self.condition:
+            self.waiting.append(job)
+            self.condition.notify()
+        job.done.wait()
+        if job.error is not None:
+            raise job.error
+        return job.result
+
+    def run(self):
+        active = []
+        while True:
+            with self.condition:
+                while not self.waiting and not active:
+                    self.condition.wait()
+                self.waiting.sort(key=_Job.deadline)
+                n = self.max_batch - len(active)
+                active += self.waiting[:n]
+                del self.waiting[:n]
+            active.sort(key=_Job.deadline)
+
+            for job in active:
+                self.advance(job)
+            for job in active:
+                if job.finished:
+                    job.done.set()
+            active = [job for job in active if not job.finished]
+            try:
+                self.forward(active)
+            except Exception as e:
+                logger.exception("Batched forward pass failed")
+                for job in active:
+                    job.steps.close()
+                    job.error = e
+                    job.done.set()
+                active = []
+
+    def advance(self, job):
+        '''Runs the decoding of the session until its next forward pass, or to its end.'''
+        self.shared.session = job.session
+        try:
+            job.request = job.steps.send(job.reply)
+        except StopIteration as e:
+            job.finished = True
+            job.result = e.value
+        except Exception as e:
+            logger.exception("Decoding failed")
+            job.finished = True
+            job.error = e
+        finally:
+            self.shared.session = None
+        job.reply = None
+
+    def is_batchable(self, job):
+        '''A single-token step of the eager decoder, with the KV cache of the previous tokens.'''
+        kind, *args = job.request
+        if kind != "logits" or self.shared.compiled:
+            return False
+        tokens, _, logits_positions = args
+        return tokens.shape[1] == 1 and logits_positions is None and bool(job.session.kv_cache)
+
+    @torch.no_grad()
+    def forward(self, jobs):
+        encode = [job for job in jobs if job.request[0] == "encode"]
+        if encode:
+            mel = torch.cat([job.request[1] for job in encode])
+            with metrics.stage_seconds.time(stage="encoder"):
+                features = self.shared.encoder(mel)
+            for i, job in enumerate(encode):
+                # copied, because the session caches its features, and a view would keep the whole batch
+                job.reply = features[i:i + 1].clone()
+            self.encoder_batches += 1
+            self.encoded += len(encode)
+
+        steps = [job for job in jobs if job.request[0] == "logits" and self.is_batchable(job)]
+        if len(steps) < 2:
+            steps = []
+        for job in jobs:
+            if job.reply is None and job not in steps:
+                # e.g. the first pass over the prompt, or the compiled decoder
+                self.shared.session = job.session
+                try:
+                    job.reply = job.session.forward(job.request)
+                finally:
+                    self.shared.session = None
+        if steps:
+            with metrics.stage_seconds.time(stage="decoder_step"):
+                self.decoder_step(steps)
+            self.decoder_batches += 1
+            self.decoded += len(steps)
+
+    def decoder_step(self, jobs):
+        '''One step of TextDecoder for the last token of every job, with the KV cache of its session. The same
+        computation as the eager forward with the KV cache hooks, but the Linear layers run on all rows at once.'''
+        dec = self.shared.model.decoder
+        sessions = [job.session for job in jobs]
+        tokens = [job.request[1] for job in jobs]
+        rows = []
+        beg = 0
+        for t in tokens:
+            rows.append(slice(beg, beg + t.shape[0]))
+            beg += t.shape[0]
+
+        # the position of the new token is the length of the self-attention KV cache
+        offsets = [next(iter(s.kv_cache.values())).shape[1] for s in sessions]
+        positions = torch.tensor([o for o, t in zip(offsets, tokens) for _ in range(t.shape[0])],
+                                 device=tokens[0].device)
+        h = dec.token_embedding(torch.cat(tokens)) + dec.positional_embedding.index_select(0, positions).unsqueeze(1)
+
+        for block in dec.blocks:
+            attn = block.attn
+            a = block.attn_ln(h)
+            q, k, v = attn.query(a), attn.key(a), attn.value(a)
+            out = []
+            for s, r in zip(sessions, rows):
+                kv = s.kv_cache
+                kv[attn.key.cache_id] = torch.cat([kv[attn.key.cache_id], k[r]], dim=1).detach()
+                kv[attn.value.cache_id] = torch.cat([kv[attn.value.cache_id], v[r]], dim=1).detach()
+                out.append(attn.qkv_attention(q[r], kv[attn.key.cache_id], kv[attn.value.cache_id], dec.mask)[0])
+            h = h + attn.out(torch.cat(out))
+
+            attn = block.cross_attn
+            q = attn.query(block.cross_attn_ln(h))
+            out = []
+            for s, r in zip(sessions, rows):
+                o, qk = attn.qkv_attention(q[r], s.kv_cache[attn.key.cache_id], s.kv_cache[attn.value.cache_id])
+                out.append(o)
+                self.shared.session = s
+                self.shared.capture_cross_attention(qk)
+            self.shared.session = None
+            h = h + attn.out(torch.cat(out))
+
+            h = h + block.mlp(block.mlp_ln(h))
+
+        logits = dec.ln(h) @ torch.transpose(dec.token_embedding.weight, 0, 1)
+        for job, r in zip(jobs, rows):
+            job.reply = logits[r]
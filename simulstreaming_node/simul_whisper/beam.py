@@ -1,17 +1,181 @@
-from .whisper.decoding import PyTorchInference
+import logging
+
+import torch
+import torch.nn.functional as F
+from torch import Tensor
+
+from .whisper.decoding import PyTorchInference, BeamSearchDecoder, GreedyDecoder, TokenDecoder
+
+logger = logging.getLogger(__name__)
 
 # extention of PyTorchInference for beam search
 class BeamPyTorchInference(PyTorchInference):
 
+    def __init__(self, model, initial_token_length, decoder=None):
+        super().__init__(model, initial_token_length)
+        # the decoder forward with the kv_cache dict, e.g. the compiled one
+        self.decoder = model.decoder if decoder is None else decoder
+
     def _kv_modules(self):
         key_modules = [block.attn.key.cache_id for block in self.model.decoder.blocks]
         value_modules = [block.attn.value.cache_id for block in self.model.decoder.blocks]
         return key_modules + value_modules
 
     def rearrange_kv_cache(self, source_indices):
+        if isinstance(source_indices, Tensor):
+            # from VectorizedBeamSearchDecoder: the indices stay on the device, no conversion to a list.
+            # The number of rows may change, in AdaptiveBeamSearchDecoder.
+            kv_modules = self._kv_modules()
+            n_rows = self.kv_cache[kv_modules[0]].shape[0]
+            if len(source_indices) == n_rows and torch.equal(source_indices, torch.arange(n_rows, device=source_indices.device)):
+                return
+            for module_cache_id in kv_modules:
+                self.kv_cache[module_cache_id] = self.kv_cache[module_cache_id].index_select(0, source_indices)
+            return
         if source_indices != list(range(len(source_indices))):
             for module_cache_id in self._kv_modules():
                 self.kv_cache[module_cache_id] = self.kv_cache[module_cache_id][source_indices].detach()
-    from torch import Tensor
-    def logits(self, tokens: Tensor, audio_features: Tensor) -> Tensor:
-        return self.model.decoder(tokens, audio_features, kv_cache=self.kv_cache)
\ No newline at end of file
+
+    def logits(self, tokens: Tensor, audio_features: Tensor, logits_positions=None) -> Tensor:
+        return self.decoder(tokens, audio_features, kv_cache=self.kv_cache, logits_positions=logits_positions)
+
+
+class VectorizedBeamSearchDecoder(BeamSearchDecoder):
+    '''Tensor-native BeamSearchDecoder. It selects the same hypotheses as BeamSearchDecoder.update, but the
+    candidates are ranked with tensor ops, without building Python tuples of the token prefixes, without
+    .item() calls in loops and without rebuilding the token tensor from lists.
+    Only the finished sequences (ending with EOT) are converted to Python, because finalize() expects them so.
+    '''
+
+    def update(self, tokens: Tensor, logits: Tensor, sum_logprobs: Tensor):
+        if tokens.shape[0] % self.beam_size != 0:
+            raise ValueError(f"{tokens.shape}[0] % {self.beam_size} != 0")
+
+        beam = self.beam_size
+        n_audio = tokens.shape[0] // beam
+        if self.finished_sequences is None:  # for the first update
+            self.finished_sequences = [{} for _ in range(n_audio)]
+        device = tokens.device
+        ar = torch.arange(beam, device=device)
+
+        # Beams with an identical prefix (e.g. at the first step, when the start tokens are repeated to beam size)
+        # produce identical candidates. BeamSearchDecoder merges them in a dict keyed by the sequence: the candidate
+        # keeps the position of the first such beam, and the score and the source of the last one. We do the same.
+        prefixes = tokens.view(n_audio, beam, -1)
+        same = (prefixes[:, :, None, :] == prefixes[:, None, :, :]).all(dim=-1)  # n_audio, beam, beam
+        first = same.int().argmax(dim=-1)  # argmax returns the first maximal index
+        last = beam - 1 - same.flip(-1).int().argmax(dim=-1)
+        keep = (first == ar).flatten()
+        src = (last + (torch.arange(n_audio, device=device) * beam)[:, None]).flatten()  # n_batch
+
+        # STEP 1: the cumulative log probabilities of beam_size+1 best candidates of every beam
+        logprobs = F.log_softmax(logits.float(), dim=-1)
+        top_logprobs, top_tokens = logprobs.topk(beam + 1)
+        scores = sum_logprobs[src][:, None] + top_logprobs[src]
+        scores[~keep] = -float("inf")
+
+        n_cand = beam * (beam + 1)
+        scores = scores.view(n_audio, n_cand)
+        cand_tokens = top_tokens[src].view(n_audio, n_cand)
+        cand_src = src[:, None].expand(-1, beam + 1).reshape(n_audio, n_cand)
+
+        # STEP 2: rank the candidates, keep the top beam_size not finished ones, and the finished ones ranked before them
+        order = scores.sort(dim=-1, descending=True, stable=True).indices
+        scores = scores.gather(1, order)
+        cand_tokens = cand_tokens.gather(1, order)
+        cand_src = cand_src.gather(1, order)
+
+        is_eot = cand_tokens == self.eot
+        not_eot = ~is_eot
+        saved_before = not_eot.cumsum(dim=-1) - not_eot.int()
+        selected = not_eot & (saved_before < beam)
+        finished = is_eot & (saved_before < beam)
+
+        # positions of the selected candidates, in the ranked order
+        pos = (~selected).int().sort(dim=-1, stable=True).indices[:, :beam]
+        source_indices = cand_src.gather(1, pos).flatten()
+        sum_logprobs.copy_(scores.gather(1, pos).flatten())
+        new_tokens = torch.cat([tokens[source_indices], cand_tokens.gather(1, pos).flatten()[:, None]], dim=-1)
+        self.inference.rearrange_kv_cache(source_indices)
+
+        # add newly finished sequences to self.finished_sequences
+        if finished.any():
+            for i, p in finished.nonzero().tolist():
+                previously_finished = self.finished_sequences[i]
+                if len(previously_finished) >= self.max_candidates:
+                    continue  # the candidate list is full
+                sequence = tuple(tokens[cand_src[i, p]].tolist() + [self.eot])
+                previously_finished[sequence] = scores[i, p].item()
+
+        # mark as completed if all audio has enough number of samples
+        completed = all(
+            len(sequences) >= self.max_candidates
+            for sequences in self.finished_sequences
+        )
+        return new_tokens, completed
+
+
+def entropy(logits: Tensor) -> Tensor:
+    """entropy of the distribution given by logits, in nats, for each row"""
+    return torch.special.entr(logits.float().softmax(dim=-1)).sum(dim=-1)
+
+
+class AdaptiveBeamSearchDecoder(TokenDecoder):
+    '''Greedy decoding while the model is confident, beam search only for the uncertain stretches.
+
+    It decodes one hypothesis while the entropy of the next-token distribution is at most entropy_threshold.
+    When it is higher, the hypothesis is widened to beam_size beams, and the beam search goes on until all
+    the beams agree on the prefix except the last token, and the model is confident again. Then it collapses
+    back to the best hypothesis.
+
+    The number of rows of tokens (and of the KV cache) is therefore 1 or beam_size. sum_logprobs is always of
+    beam_size, only the first rows are used.
+    saved_beam_steps counts the decoder steps of the beams that were not computed, compared to beam search.
+    '''
+
+    def __init__(self, beam_size: int, eot: int, inference: BeamPyTorchInference, entropy_threshold: float):
+        self.beam_size = beam_size
+        self.eot = eot
+        self.inference = inference
+        self.entropy_threshold = entropy_threshold
+        self.greedy = GreedyDecoder(0.0, eot)
+        self.beam = VectorizedBeamSearchDecoder(beam_size=beam_size, eot=eot, inference=inference)
+        self.saved_beam_steps = 0
+        self.reset()
+
+    def reset(self):
+        self.wide = False
+        self.beam.reset()
+
+    def _rows(self, n, device):
+        return torch.zeros(n, dtype=torch.long, device=device)
+
+    def update(self, tokens: Tensor, logits: Tensor, sum_logprobs: Tensor):
+        if not self.wide:
+            if entropy(logits[0]).item() <= self.entropy_threshold:
+                self.saved_beam_steps += self.beam_size - 1
+                return self.greedy.update(tokens, logits, sum_logprobs[:1])
+
+            # uncertain: widen the only hypothesis to beam_size identical beams
+            logger.debug("adaptive beam: widening")
+            rows = self._rows(self.beam_size, tokens.device)
+            tokens, logits = tokens[rows], logits[rows]
+            sum_logprobs[1:] = sum_logprobs[0]
+            self.inference.rearrange_kv_cache(rows)
+            self.wide = True
+
+        previous = tokens
+        tokens, completed = self.beam.update(tokens, logits, sum_logprobs)
+        if completed:
+            return tokens, completed
+
+        # collapse when the beams extend the same hypothesis and the model was confident about the continuation
+        if (tokens[:, :-1] == tokens[:1, :-1]).all():
+            parent = (previous == tokens[0, :-1]).all(dim=-1)
+            if entropy(logits[parent][:1]).item() <= self.entropy_threshold:
+                logger.debug("adaptive beam: collapsing")
+                self.inference.rearrange_kv_cache(self._rows(1, tokens.device))
+                tokens = tokens[:1]
+                self.beam.reset()
+                self.wide = False
+        return tokens, completed
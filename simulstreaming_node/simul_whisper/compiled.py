@@ -0,0 +1,189 @@
+import os
+import logging
+from typing import List
+
+import torch
+import torch.nn.functional as F
+from torch import Tensor, nn
+
+logger = logging.getLogger(__name__)
+
+# Compiled path of the Whisper encoder and of the single-token decoder step, for PaddedAlignAttWhisper.
+#
+# In the eager path, the KV cache and the cross-attention of the alignment heads are captured by forward hooks.
+# The hooks mutate Python state in every layer, so the decoder can't be compiled to one graph. Here, the KV cache
+# and the cross-attention are explicit tensor inputs and outputs of the decoder step instead.
+#
+# The self-attention KV cache is preallocated in buckets of BUCKET positions, and the positions after its length
+# are masked. So the compiled step has only a few shapes (the bucket size and the number of hypotheses), and it is
+# not recompiled after every token.
+
+BUCKET = 64
+LENGTH = "_length"  # key of the number of valid positions in the kv_cache dict
+
+
+def _attention(n_head: int, q: Tensor, k: Tensor, v: Tensor, mask: Tensor = None):
+    '''The same computation as MultiHeadAttention.qkv_attention, with an additive mask over the keys.'''
+    n_state = q.shape[-1]
+    scale = (n_state // n_head) ** -0.25
+    q = q.view(*q.shape[:2], n_head, -1).permute(0, 2, 1, 3)
+    k = k.view(*k.shape[:2], n_head, -1).permute(0, 2, 1, 3)
+    v = v.view(*v.shape[:2], n_head, -1).permute(0, 2, 1, 3)
+    qk = (q * scale) @ (k * scale).transpose(-1, -2)
+    if mask is not None:
+        qk = qk + mask
+    qk = qk.float()
+    w = F.softmax(qk, dim=-1).to(q.dtype)
+    out = (w @ v).permute(0, 2, 1, 3).flatten(start_dim=2)
+    return out, qk.detach()
+
+
+class DecoderStep(nn.Module):
+    '''One decoding step of TextDecoder for one new token, with the KV cache as explicit tensors.
+
+    x: (B, 1) the new token
+    self_ks, self_vs: per layer (B, bucket, n_state), the self-attention keys and values. Only the first `length`
+        positions are valid.
+    cross_ks, cross_vs: per layer (B or 1, n_audio_ctx, n_state)
+    length: (1,) long tensor
+
+    Returns the logits (B, 1, n_vocab), and per layer the new self-attention keys and values (B, 1, n_state) and
+    the cross-attention qk (B, n_head, 1, n_audio_ctx).
+    '''
+
+    def __init__(self, decoder):
+        super().__init__()
+        self.decoder = decoder
+
+    def forward(self, x: Tensor, self_ks: List[Tensor], self_vs: List[Tensor], cross_ks: List[Tensor],
+                cross_vs: List[Tensor], length: Tensor):
+        dec = self.decoder
+        h = dec.token_embedding(x) + dec.positional_embedding.index_select(0, length)
+        bucket = self_ks[0].shape[1]
+        positions = torch.arange(bucket + 1, device=x.device)
+        valid = (positions < length) | (positions == bucket)  # the last one is the new token
+        mask = torch.zeros(bucket + 1, device=x.device).masked_fill(~valid, -float("inf"))
+
+        new_ks, new_vs, cross_qks = [], [], []
+        for i, block in enumerate(dec.blocks):
+            a = block.attn_ln(h)
+            k_new = block.attn.key(a)
+            v_new = block.attn.value(a)
+            k = torch.cat([self_ks[i], k_new], dim=1)
+            v = torch.cat([self_vs[i], v_new], dim=1)
+            out, _ = _attention(block.attn.n_head, block.attn.query(a), k, v, mask)
+            h = h + block.attn.out(out)
+            new_ks.append(k_new)
+            new_vs.append(v_new)
+
+            a = block.cross_attn_ln(h)
+            out, qk = _attention(block.cross_attn.n_head, block.cross_attn.query(a), cross_ks[i], cross_vs[i])
+            h = h + block.cross_attn.out(out)
+            cross_qks.append(qk)
+
+            h = h + block.mlp(block.mlp_ln(h))
+
+        h = dec.ln(h)
+        logits = h @ torch.transpose(dec.token_embedding.weight, 0, 1)
+        return logits, new_ks, new_vs, cross_qks
+
+
+class CompiledDecoder:
+    '''Replacement of TextDecoder.forward with the kv_cache dict, for a decoder without the KV cache hooks.
+
+    The first call with an empty kv_cache (the prompt) runs eagerly and fills the cache, the next ones (one token)
+    run the compiled DecoderStep. The self-attention cache stays in the dict under the cache_ids of the key and
+    value layers, so that BeamPyTorchInference.rearrange_kv_cache works with it.
+
+    on_cross_attention: called with the cross-attention qk of every layer, like the hook of the eager path.
+    '''
+
+    def __init__(self, decoder, on_cross_attention):
+        self.decoder = decoder
+        self.on_cross_attention = on_cross_attention
+        # one compiled graph for every bucket and number of hypotheses
+        torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit, 64)
+        self.step = torch.compile(DecoderStep(decoder))
+        blocks = decoder.blocks
+        self.self_k_ids = [b.attn.key.cache_id for b in blocks]
+        self.self_v_ids = [b.attn.value.cache_id for b in blocks]
+        self.cross_k_ids = [b.cross_attn.key.cache_id for b in blocks]
+        self.cross_v_ids = [b.cross_attn.value.cache_id for b in blocks]
+
+    def __call__(self, x: Tensor, xa: Tensor, kv_cache: dict, logits_positions=None, logits_tokens=None):
+        if LENGTH not in kv_cache:
+            return self.prefill(x, xa, kv_cache, logits_positions, logits_tokens)
+        if x.shape[1] != 1 or logits_tokens is not None:
+            raise ValueError("Only one new token can be decoded with the KV cache in the compiled path.")
+
+        length = kv_cache[LENGTH]
+        if length == kv_cache[self.self_k_ids[0]].shape[1]:
+            self._grow(kv_cache, length + BUCKET)
+        logits, new_ks, new_vs, cross_qks = self.step(
+            x,
+            [kv_cache[i] for i in self.self_k_ids],
+            [kv_cache[i] for i in self.self_v_ids],
+            [kv_cache[i] for i in self.cross_k_ids],
+            [kv_cache[i] for i in self.cross_v_ids],
+            torch.tensor([length], device=x.device),
+        )
+        for ids, new in ((self.self_k_ids, new_ks), (self.self_v_ids, new_vs)):
+            for i, t in zip(ids, new):
+                kv_cache[i][:, length] = t[:, 0]
+        kv_cache[LENGTH] = length + 1
+        for qk in cross_qks:
+            self.on_cross_attention(qk)
+        if logits_positions is not None:
+            logits = logits[:, list(logits_positions)]
+        return logits
+
+    def _grow(self, kv_cache, size):
+        for i in self.self_k_ids + self.self_v_ids:
+            t = kv_cache[i]
+            kv_cache[i] = F.pad(t, (0, 0, 0, size - t.shape[1]))
+
+    def prefill(self, x: Tensor, xa: Tensor, kv_cache: dict, logits_positions=None, logits_tokens=None):
+        '''The forward pass of TextDecoder over the prompt, with the same modules and attention as in the eager path.'''
+        dec = self.decoder
+        n = x.shape[-1]
+        h = dec.token_embedding(x) + dec.positional_embedding[:n]
+        for i, block in enumerate(dec.blocks):
+            a = block.attn_ln(h)
+            k = block.attn.key(a)
+            v = block.attn.value(a)
+            out, _ = block.attn.qkv_attention(block.attn.query(a), k, v, dec.mask[:n, :n])
+            h = h + block.attn.out(out)
+            kv_cache[self.self_k_ids[i]] = k
+            kv_cache[self.self_v_ids[i]] = v
+
+            a = block.cross_attn_ln(h)
+            ck = block.cross_attn.key(xa)
+            cv = block.cross_attn.value(xa)
+            out, qk = block.cross_attn.qkv_attention(block.cross_attn.query(a), ck, cv)
+            h = h + block.cross_attn.out(out)
+            kv_cache[self.cross_k_ids[i]] = ck
+            kv_cache[self.cross_v_ids[i]] = cv
+            self.on_cross_attention(qk)
+
+            h = h + block.mlp(block.mlp_ln(h))
+        kv_cache[LENGTH] = n
+        # the cache is preallocated to the next bucket
+        self._grow(kv_cache, (n // BUCKET + 1) * BUCKET)
+
+        if logits_positions is not None:
+            h = h[:, list(logits_positions)]
+        h = dec.ln(h)
+        weight = dec.token_embedding.weight
+        if logits_tokens is not None:
+            weight = weight[list(logits_tokens)]
+        return h @ torch.transpose(weight, 0, 1)
+
+
+def set_compile_cache_dir(cache_dir):
+    '''The compiled artifacts are cached in this directory, so that a warm restart skips the compilation.'''
+    # imported here, because importing the inductor takes seconds
+    import torch._inductor.config
+
+    os.makedirs(cache_dir, exist_ok=True)
+    os.environ["TORCHINDUCTOR_CACHE_DIR"] = os.path.abspath(cache_dir)
+    torch._inductor.config.fx_graph_cache = True
@@ -10,12 +10,22 @@ class SimulWhisperConfig:
     language: str = field(default="zh")
     nonspeech_prob: float = 1.0
     audio_min_len: float = 1.0
-    decoder_type: Literal["greedy","beam"] = "greedy"
+    decoder_type: Literal["greedy","beam","adaptive"] = "greedy"
     beam_size: int = 5
+    adaptive_entropy: float = field(default=1.0, metadata={"help": "Entropy threshold (in nats) of the adaptive decoder. It decodes greedily while the entropy is at most this value."})
     task: Literal["transcribe","translate"] = "transcribe"
+    compile: bool = field(default=False, metadata={"help": "Compiled encoder and single-token decoder step, with torch.compile."})
+    compile_cache_dir: str = field(default=None, metadata={"help": "Directory to cache the compiled artifacts for warm restarts."})
+    batch_sessions: int = field(default=1, metadata={"help": "Max number of sessions sharing the model whose forward passes run in one batch. 1: the sessions decode one after another."})
+    precision: Literal["fp32","bf16","int8-dynamic"] = field(default="fp32", metadata={"help": "Precision of the Linear layers of the encoder and decoder."})
     init_prompt: str = field(default=None)
     static_init_prompt: str = field(default=None)
     max_context_tokens: int = field(default=None)
+    max_tokens_per_second: float = field(default=0.0, metadata={"help": "Budget of new tokens per second of new audio in one decoding. 0: unlimited."})
+    repetition_count: int = field(default=0, metadata={"help": "The decoding is stopped when an n-gram repeats this many times in a row. 0: off."})
+    repetition_ngram: int = field(default=4, metadata={"help": "Max n of the n-grams for repetition_count."})
+    lang_redetect_interval: int = field(default=10, metadata={"help": "With language auto, the language is detected again after this many segments. 0: never."})
+    lang_redetect_logprob: float = field(default=-1.0, metadata={"help": "With language auto, the language is detected again in the next segment when the average log probability of the decoded tokens drops below this."})
 
     logdir: str = field(default="logdir", metadata={"help": "Directory to save audio segments and tokens for debugging purposes."})
 
@@ -27,5 +37,7 @@ class AlignAttConfig(SimulWhisperConfig):
     frame_threshold: int = 4
     rewind_threshold: int = 200 # in frames. Max value is 1500. Higher value turns rewinds off.
     audio_max_len: float = 30.0
+    audio_trim_margin: float = field(default=None, metadata={"help": "If set, the audio before the last committed word, except this margin in seconds, is trimmed and its words are moved to the context."})
     cif_ckpt_path: str = ""
-    never_fire: bool = False
\ No newline at end of file
+    never_fire: bool = False
+    silence_rms: float = field(default=0.0, metadata={"help": "The decoding is deferred while the RMS of the new audio is below this. 0: off."})
\ No newline at end of file
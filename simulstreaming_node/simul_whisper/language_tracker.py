@@ -0,0 +1,59 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+# session-level language of PaddedAlignAttWhisper with --language auto
+
+class LanguageTracker:
+    '''Keeps the detected language across the segments of one session, because it rarely changes.
+
+    The language is detected again only when it is unknown, after redetect_interval segments, or in the next
+    segment after the decoding confidence (the average log probability of the decoded tokens) dropped below
+    redetect_logprob.
+    '''
+
+    def __init__(self, redetect_interval=10, redetect_logprob=-1.0):
+        self.redetect_interval = redetect_interval
+        self.redetect_logprob = redetect_logprob
+        self.reset()
+
+    def reset(self):
+        '''new session, the language is unknown'''
+        self.language = None
+        self.probability = None
+        self.segments_since_detection = 0
+        self.low_confidence = False
+        self.decoded = False  # whether the current segment was decoded
+
+    def needs_detection(self):
+        if self.language is None or self.low_confidence:
+            return True
+        return self.redetect_interval > 0 and self.segments_since_detection >= self.redetect_interval
+
+    def update(self, language, probability):
+        '''Returns True if the language changed.'''
+        changed = language != self.language
+        if changed and self.language is not None:
+            logger.info(f"Language changed from {self.language} to {language} (p={probability:.4f})")
+        self.language = language
+        self.probability = probability
+        self.segments_since_detection = 0
+        self.low_confidence = False
+        return changed
+
+    def report_confidence(self, sum_logprob, num_tokens):
+        self.decoded = True
+        if num_tokens == 0 or self.language is None:
+            return
+        avg_logprob = sum_logprob / num_tokens
+        if avg_logprob < self.redetect_logprob:
+            if not self.low_confidence:
+                logger.info(f"Low decoding confidence (avg logprob {avg_logprob:.3f}), "
+                            "the language will be detected again in the next segment")
+            self.low_confidence = True
+
+    def new_segment(self):
+        # the segment is refreshed also when no audio was decoded, e.g. at the start of a voiced segment with VAC
+        if self.decoded:
+            self.segments_since_detection += 1
+        self.decoded = False
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+
+# Flat, memory-mapped format of the Whisper weights.
+#
+# load_model() reads the whole .pt checkpoint and copies it to the model, so every worker process holds its own
+# copy of the weights. A .mmap file is converted once from the checkpoint. It contains the fp32 weights, the
+# model dims and the alignment heads. Workers map it read-only, so they share the physical pages of the page cache,
+# and loading takes only the time of constructing the model without initializing its weights.
+#
+# File layout: MAGIC, 8 bytes of the little-endian header length, JSON header, and the tensors, every one
+# aligned to ALIGN bytes. The header has the dims, the alignment heads mask, and the dtype, shape and offset
+# of every tensor.
+#
+# Conversion:
+#   python3 -m simul_whisper.mmap_model large-v3.pt large-v3.mmap
+
+import os
+import json
+import logging
+import warnings
+from dataclasses import asdict
+
+import numpy as np
+import torch
+
+from .whisper import load_model, _MODELS
+from .whisper.model import Whisper, ModelDimensions
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"WHSPMMAP"
+ALIGN = 64
+SUFFIX = ".mmap"
+
+
+def convert(model_path, out_path):
+    '''model_path: official model name or .pt checkpoint, as for load_model'''
+    name = os.path.basename(model_path).replace(".pt", "")
+    if name in _MODELS:
+        # loaded by the name as in SharedWhisperModel, from (or downloaded to) the directory of model_path, so that
+        # the official alignment heads are set. load_model of the file path would set the default ones.
+        model = load_model(name, device="cpu", download_root=os.path.dirname(os.path.abspath(model_path)))
+    else:
+        logger.warning(f"{name} is not an official model, the default alignment heads are used: all heads of the "
+                       "second half of the decoder layers.")
+        model = load_model(model_path, device="cpu")
+    state = {k: v.contiguous() for k, v in model.state_dict().items()}
+
+    tensors = {}
+    offset = 0
+    for k, v in state.items():
+        tensors[k] = {"dtype": str(v.numpy().dtype), "shape": list(v.shape), "offset": offset}
+        offset += (v.numel() * v.element_size() + ALIGN - 1) // ALIGN * ALIGN
+    header = json.dumps({
+        "dims": asdict(model.dims),
+        "alignment_heads": model.alignment_heads.to_dense().tolist(),
+        "tensors": tensors,
+    }).encode("utf-8")
+    data_start = (len(MAGIC) + 8 + len(header) + ALIGN - 1) // ALIGN * ALIGN
+
+    with open(out_path, "wb") as f:
+        f.write(MAGIC)
+        f.write(len(header).to_bytes(8, "little"))
+        f.write(header)
+        for k, v in state.items():
+            f.seek(data_start + tensors[k]["offset"])
+            f.write(v.numpy().tobytes())
+        f.truncate(data_start + offset)
+    logger.info(f"Converted {model_path} to {out_path}")
+
+
+def load_mmap_model(path, device=None):
+    '''Loads the model from a .mmap file. On CPU, the weights stay mapped read-only and they must not be
+    modified in place.'''
+    if device is None:
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a Whisper .mmap file.")
+        header_len = int.from_bytes(f.read(8), "little")
+        header = json.loads(f.read(header_len))
+    data_start = (len(MAGIC) + 8 + header_len + ALIGN - 1) // ALIGN * ALIGN
+    data = np.memmap(path, dtype=np.uint8, mode="r", offset=data_start)
+
+    state = {}
+    with warnings.catch_warnings():
+        # the mapped memory is read-only, it's intended
+        warnings.filterwarnings("ignore", message="The given NumPy array is not writable")
+        for k, t in header["tensors"].items():
+            dtype = np.dtype(t["dtype"])
+            n = int(np.prod(t["shape"]))
+            array = data[t["offset"]:t["offset"] + n * dtype.itemsize].view(dtype).reshape(t["shape"])
+            state[k] = torch.from_numpy(array)
+
+    dims = ModelDimensions(**header["dims"])
+    # no memory is allocated and no weights are initialized, they are assigned from the mapped file
+    with torch.device("meta"):
+        model = Whisper(dims)
+    model.load_state_dict(state, assign=True)
+    # the non-persistent buffers are not in the file
+    mask = torch.empty(dims.n_text_ctx, dims.n_text_ctx).fill_(-np.inf).triu_(1)
+    model.decoder.register_buffer("mask", mask, persistent=False)
+    heads = torch.tensor(header["alignment_heads"], dtype=torch.bool)
+    model.register_buffer("alignment_heads", heads.to_sparse(), persistent=False)
+    return model.to(device)
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Converts a Whisper checkpoint to the memory-mapped format.")
+    parser.add_argument("model_path", type=str, help="Official model name or .pt checkpoint.")
+    parser.add_argument("out_path", type=str, help=f"Output file, it should end with {SUFFIX}.")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    convert(args.model_path, args.out_path)
@@ -0,0 +1,78 @@
+import logging
+
+import torch
+import torch.nn.functional as F
+from torch import nn
+
+logger = logging.getLogger(__name__)
+
+# reduced-precision inference modes of the Whisper model, mainly for CPU-only hosts.
+# Only the Linear layers of the encoder and decoder are affected. LayerNorm, the attention softmax
+# (it is computed from float qk, also in the alignment heads hook) and the logits (the projection
+# to the token embedding, which is not a Linear layer) stay in fp32, so that the AlignAtt timing is stable.
+
+PRECISIONS = ["fp32", "bf16", "int8-dynamic"]
+
+
+class BFloat16Linear(nn.Linear):
+    '''Linear layer with bf16 weights. The input is cast to bf16, the output back to fp32.'''
+
+    def forward(self, x):
+        return F.linear(x.to(torch.bfloat16), self.weight, self.bias).float()
+
+    @classmethod
+    def from_linear(cls, linear: nn.Linear):
+        new = cls(linear.in_features, linear.out_features, bias=linear.bias is not None,
+                  device=linear.weight.device, dtype=torch.bfloat16)
+        with torch.no_grad():
+            new.weight.copy_(linear.weight)
+            if linear.bias is not None:
+                new.bias.copy_(linear.bias)
+        return new
+
+
+def _linear_layers(model):
+    for part in (model.encoder, model.decoder):
+        for name, module in part.named_modules():
+            if type(module) is nn.Linear:
+                yield part, name, module
+
+
+def _swap(part, name, new):
+    parent_name, _, attr = name.rpartition(".")
+    parent = part.get_submodule(parent_name) if parent_name else part
+    setattr(parent, attr, new)
+
+
+def apply_precision(model, precision="fp32"):
+    '''Converts the Linear layers of the Whisper model in place. It must be called before any forward hooks are
+    registered on them.
+
+    precision: "fp32" (no change), "bf16", or "int8-dynamic" (dynamic quantization, weights in int8, CPU only).
+    '''
+    if precision == "fp32":
+        return model
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unknown precision {precision}. Use one of {PRECISIONS}.")
+    device = model.device
+    if precision == "int8-dynamic":
+        if device.type != "cpu":
+            raise ValueError("int8-dynamic precision is supported only on CPU.")
+        make = lambda linear: torch.ao.nn.quantized.dynamic.Linear.from_float(linear)
+        # from_float requires the qconfig of the float module
+        for _, _, linear in _linear_layers(model):
+            linear.qconfig = torch.ao.quantization.default_dynamic_qconfig
+    else:
+        if device.type == "cuda" and not torch.cuda.is_bf16_supported():
+            raise ValueError("bf16 precision is not supported on this GPU.")
+        make = BFloat16Linear.from_linear
+    n = 0
+    for part, name, linear in list(_linear_layers(model)):
+        new = make(linear)
+        # the KV cache hooks identify the key and value layers by cache_id
+        if hasattr(linear, "cache_id"):
+            new.cache_id = linear.cache_id
+        _swap(part, name, new)
+        n += 1
+    logger.info(f"Precision {precision}: {n} Linear layers converted.")
+    return model
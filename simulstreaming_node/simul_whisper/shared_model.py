@@ -0,0 +1,125 @@
+import os
+import logging
+import threading
+from contextlib import contextmanager
+from functools import lru_cache
+
+import torch
+import torch.nn.functional as F
+
+from .whisper import load_model
+from .precision import apply_precision
+from .compiled import CompiledDecoder, set_compile_cache_dir
+from .mmap_model import load_mmap_model, SUFFIX as MMAP_SUFFIX
+from .batching import BatchScheduler
+
+logger = logging.getLogger(__name__)
+
+# The loaded Whisper model is shared by all PaddedAlignAttWhisper objects in the process that use the same model file
+# and options, e.g. one per client connection of the server. Each of them has its own decoding state: the audio
+# buffer, the tokens, the context, the KV cache and the cross-attention of the current decoding. The forward hooks are
+# installed once and they write to the session that holds the lock, so the inference of the sessions is serialised.
+# With batch_sessions > 1, the forward passes of the sessions are batched by BatchScheduler instead.
+
+
+class FairLock:
+    '''A lock that is acquired in the order of the requests, so that a session that decodes in a loop can't starve the
+    others. threading.Lock doesn't guarantee any order.'''
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.next_ticket = 0
+        self.serving = 0
+
+    def __enter__(self):
+        with self.condition:
+            ticket = self.next_ticket
+            self.next_ticket += 1
+            while ticket != self.serving:
+                self.condition.wait()
+
+    def __exit__(self, *exc):
+        with self.condition:
+            self.serving += 1
+            self.condition.notify_all()
+
+
+class SharedWhisperModel:
+    '''Whisper model with its encoder and decoder, compiled or not, and the hooks that capture the KV cache and the
+    cross-attention for the active session.'''
+
+    def __init__(self, model_path, precision="fp32", compile=False, compile_cache_dir=None, batch_sessions=1):
+        if model_path.endswith(MMAP_SUFFIX):
+            # converted by simul_whisper.mmap_model, the weights are shared by the processes that map it
+            self.name = os.path.basename(model_path)[:-len(MMAP_SUFFIX)]
+            self.model = load_mmap_model(model_path)
+        else:
+            self.name = os.path.basename(model_path).replace(".pt", "")
+            download_root = os.path.dirname(os.path.abspath(model_path))
+            self.model = load_model(name=self.name, download_root=download_root)
+        # before the hooks are installed, because the Linear layers are replaced
+        apply_precision(self.model, precision)
+
+        logger.info(f"Model dimensions: {self.model.dims}")
+
+        self.max_text_len = self.model.dims.n_text_ctx
+        self.lock = FairLock()
+        self.session = None  # PaddedAlignAttWhisper that is decoding
+        self.compiled = compile
+        self.scheduler = BatchScheduler(self, batch_sessions) if batch_sessions > 1 else None
+
+        if compile:
+            # the KV cache and the cross-attention are explicit outputs of the compiled decoder step, not hooks
+            if compile_cache_dir is not None:
+                set_compile_cache_dir(compile_cache_dir)
+            self.encoder = torch.compile(self.model.encoder)
+            self.decoder = CompiledDecoder(self.model.decoder, self.capture_cross_attention)
+            return
+        self.encoder = self.model.encoder
+        self.decoder = self.model.decoder
+
+        def layer_hook(module, net_input, net_output):
+            self.capture_cross_attention(net_output[1])
+
+        for b in self.model.decoder.blocks:
+            b.cross_attn.register_forward_hook(layer_hook)
+            b.attn.key.register_forward_hook(self.kv_hook)
+            b.attn.value.register_forward_hook(self.kv_hook)
+            b.cross_attn.key.register_forward_hook(self.kv_hook)
+            b.cross_attn.value.register_forward_hook(self.kv_hook)
+
+    def capture_cross_attention(self, qk):
+        # qk: B*num_head*token_len*audio_len
+        if self.session is None:
+            return
+        t = F.softmax(qk, dim=-1)
+        self.session.dec_attns.append(t.squeeze(0))
+
+    def kv_hook(self, module: torch.nn.Linear, _, net_output: torch.Tensor):
+        if self.session is None:
+            # the batched decoder step of BatchScheduler manages the KV caches itself
+            return None
+        kv_cache = self.session.kv_cache
+        if module.cache_id not in kv_cache or net_output.shape[1] > self.max_text_len:
+            # save as-is, for the first token or cross attention
+            kv_cache[module.cache_id] = net_output
+        else:
+            x = kv_cache[module.cache_id]
+            kv_cache[module.cache_id] = torch.cat([x, net_output], dim=1).detach()
+        return kv_cache[module.cache_id]
+
+    @contextmanager
+    def use(self, session):
+        '''The model runs the forward passes of the session, the others wait for their turn.'''
+        with self.lock:
+            self.session = session
+            try:
+                yield
+            finally:
+                self.session = None
+
+
+@lru_cache(maxsize=None)
+def shared_whisper_model(model_path, precision="fp32", compile=False, compile_cache_dir=None, batch_sessions=1):
+    '''One SharedWhisperModel for every model file and options in the process.'''
+    return SharedWhisperModel(model_path, precision, compile, compile_cache_dir, batch_sessions)
@@ -6,16 +6,19 @@ import logging
 import torch
 import torch.nn.functional as F
 
-from .whisper import load_model, DecodingOptions, tokenizer
+from .whisper import DecodingOptions, tokenizer
 from .config import AlignAttConfig
 from .whisper.audio import log_mel_spectrogram, TOKENS_PER_SECOND, pad_or_trim, N_SAMPLES, N_FRAMES
-from .whisper.timing import median_filter
-from .whisper.decoding import GreedyDecoder, BeamSearchDecoder, SuppressTokens, detect_language
-from .beam import BeamPyTorchInference
+from .whisper.decoding import GreedyDecoder, SuppressTokens, detect_language
+from .beam import BeamPyTorchInference, VectorizedBeamSearchDecoder, AdaptiveBeamSearchDecoder
 from .eow_detection import fire_at_boundary, load_cif
+from .audio_buffer import SegmentAudioBuffer
+from .language_tracker import LanguageTracker
+from .shared_model import shared_whisper_model
 import os
 
 from token_buffer import TokenBuffer
+from whisper_streaming import metrics
 
 import numpy as np
 from .generation_progress import *
@@ -24,7 +27,21 @@ DEC_PAD = 50257
 logger = logging.getLogger(__name__)
 
 import sys
+import time
 import wave
+import math
+
+
+def repeated_ngram_len(tokens, max_ngram, count):
+    '''Returns n if the tokens end with an n-gram repeated count times in a row, for the shortest such
+    n <= max_ngram, otherwise 0.'''
+    for n in range(1, max_ngram + 1):
+        if n * count > len(tokens):
+            break
+        ngram = tokens[-n:]
+        if all(tokens[-(i + 1) * n:len(tokens) - i * n] == ngram for i in range(1, count)):
+            return n
+    return 0
 
 # New features added to the original version of Simul-Whisper: 
 # - large-v3 model support
@@ -38,11 +55,11 @@ class PaddedAlignAttWhisper:
         self.log_segments = 0
         if cfg.logdir is not None and not os.path.exists(cfg.logdir):
             os.makedirs(cfg.logdir)
-        model_name = os.path.basename(cfg.model_path).replace(".pt", "")
-        model_path = os.path.dirname(os.path.abspath(cfg.model_path))
-        self.model = load_model(name=model_name, download_root=model_path)
-
-        logger.info(f"Model dimensions: {self.model.dims}")
+        # the model is loaded once in the process, this object is one decoding session of it
+        self.shared = shared_whisper_model(cfg.model_path, cfg.precision, cfg.compile, cfg.compile_cache_dir,
+                                           cfg.batch_sessions)
+        self.model = self.shared.model
+        model_name = self.shared.name
 
         self.decode_options = DecodingOptions(
             language = cfg.language, 
@@ -52,6 +69,8 @@ class PaddedAlignAttWhisper:
         self.tokenizer_is_multilingual = not model_name.endswith(".en")
         self.create_tokenizer(cfg.language if cfg.language != "auto" else None)
         self.detected_language = cfg.language if cfg.language != "auto" else None
+        # with language auto, the detected language is kept across segments
+        self.language_tracker = LanguageTracker(cfg.lang_redetect_interval, cfg.lang_redetect_logprob)
         
         self.max_text_len = self.model.dims.n_text_ctx
         self.num_decoder_layers = len(self.model.decoder.blocks)
@@ -62,30 +81,11 @@ class PaddedAlignAttWhisper:
                                                                      n_audio_state=self.model.dims.n_audio_state,
                                                                      device=self.model.device)
 
-        # install hooks to access encoder-decoder attention
+        # filled by the hooks of the shared model while this session decodes
         self.dec_attns = []
-        def layer_hook(module, net_input, net_output):
-            # net_output[1]: B*num_head*token_len*audio_len
-            t = F.softmax(net_output[1], dim=-1)
-            self.dec_attns.append(t.squeeze(0))
-        for b in self.model.decoder.blocks:
-            b.cross_attn.register_forward_hook(layer_hook)
-        
         self.kv_cache = {}
-        def kv_hook(module: torch.nn.Linear, _, net_output: torch.Tensor):
-            if module.cache_id not in self.kv_cache or net_output.shape[1] > self.max_text_len:
-                # save as-is, for the first token or cross attention
-                self.kv_cache[module.cache_id] = net_output
-            else:
-                x = self.kv_cache[module.cache_id]
-                self.kv_cache[module.cache_id] = torch.cat([x, net_output], dim=1).detach()
-            return self.kv_cache[module.cache_id] 
-
-        for i,b in enumerate(self.model.decoder.blocks):
-            b.attn.key.register_forward_hook(kv_hook)
-            b.attn.value.register_forward_hook(kv_hook)
-            b.cross_attn.key.register_forward_hook(kv_hook)
-            b.cross_attn.value.register_forward_hook(kv_hook)
+        self.encoder = self.shared.encoder
+        self.decoder = self.shared.decoder
 
         self.align_source = {}
         self.num_align_heads = 0
@@ -116,7 +116,14 @@ class PaddedAlignAttWhisper:
         # blank tokens are suppresed for new segments near the line 334
 
         # it's going to be regenerated after lang id
-        self.segments = []
+        self.segments = SegmentAudioBuffer(self.cfg.audio_max_len)
+        self.idle_state = None  # decoding state in which the decoding commits nothing and changes nothing
+        self.new_audio_rms = 0.0  # max RMS of the segments inserted since the last decoding
+        self.new_audio_len = 0.0  # seconds of audio inserted since the last decoding
+        self.pending_since = None  # when the oldest audio that is not decoded yet was inserted
+        # counters of the decoding loops that were stopped early
+        self.decode_stats = {"budget_stops": 0, "repetition_stops": 0, "repetition_discarded_tokens": 0}
+        self.encoder_cache = None
         self.init_tokens()
         
         self.last_attend_frame = -self.cfg.rewind_threshold
@@ -135,10 +142,19 @@ class PaddedAlignAttWhisper:
 
         elif cfg.decoder_type == "beam":
             self.decoder_type = "beam"
-            self.inference = BeamPyTorchInference(self.model, self.initial_token_length)
+            self.inference = BeamPyTorchInference(self.model, self.initial_token_length, decoder=self.decoder)
+            self.inference.kv_cache = self.kv_cache
+
+            self.token_decoder = VectorizedBeamSearchDecoder(inference=self.inference, eot=self.tokenizer.eot, beam_size=cfg.beam_size)
+
+        elif cfg.decoder_type == "adaptive":
+            logger.info(f"Using adaptive beam decoder, entropy threshold {cfg.adaptive_entropy}")
+            self.decoder_type = "adaptive"
+            self.inference = BeamPyTorchInference(self.model, self.initial_token_length, decoder=self.decoder)
             self.inference.kv_cache = self.kv_cache
 
-            self.token_decoder = BeamSearchDecoder(inference=self.inference, eot=self.tokenizer.eot, beam_size=cfg.beam_size)
+            self.token_decoder = AdaptiveBeamSearchDecoder(inference=self.inference, eot=self.tokenizer.eot, beam_size=cfg.beam_size,
+                                                           entropy_threshold=cfg.adaptive_entropy)
 
     def create_tokenizer(self, language=None):
         self.tokenizer = tokenizer.get_tokenizer(
@@ -147,6 +163,8 @@ class PaddedAlignAttWhisper:
             num_languages=self.model.num_languages,
             task=self.decode_options.task
         )
+        # encode() would compile the regex of all the special tokens on the first call, which takes a long time
+        self.blank_tokens = self.tokenizer.encoding.encode_ordinary(" ") + [self.tokenizer.eot]
 
     def init_context(self):
         kw = {'tokenizer': self.tokenizer, 
@@ -154,9 +172,9 @@ class PaddedAlignAttWhisper:
               'prefix_token_ids': [self.tokenizer.sot_prev]}
         self.context = TokenBuffer.empty(**kw)
         if self.cfg.static_init_prompt is not None:
-            self.context = TokenBuffer.from_text(self.cfg.static_init_prompt, **kw)
+            self.context = TokenBuffer(static_text=self.cfg.static_init_prompt, **kw)
         if self.cfg.init_prompt is not None:
-            self.context.text += self.cfg.init_prompt
+            self.context.append_text(self.cfg.init_prompt)
 
     def init_tokens(self):
         logger.debug(f"init tokens, {len(self.segments)}")
@@ -170,37 +188,38 @@ class PaddedAlignAttWhisper:
 #        self.segments = []
         logger.debug(f"init tokens after, {len(self.segments)}")
         self.tokens = [self.initial_tokens]
+        # for each group in self.tokens[1:], the positions of the most attended audio of its tokens,
+        # in samples since the start, i.e. including the evicted audio
+        self.token_positions = []
 
     def trim_context(self):
         logger.info("Trimming context")
-        c = len(self.context.as_token_ids()) - len(self.context.prefix_token_ids)
+        c = self.context.num_tokens()
 #        logger.debug(f"c= {len(self.context.as_token_ids())}, {len(self.context.prefix_token_ids)}")
         logger.info(f"Context text: {self.context.as_text()}")
 #        logger.debug(f"Context tensor: {self.context.as_tensor()}")
         l = sum(t.shape[1] for t in self.tokens) + c
 #        logger.debug(f"len {l}, c {c}, max_context_tokens {self.max_context_tokens}")
-        if self.cfg.static_init_prompt is None:
-            after = 0
-        else:
-            after = len(self.cfg.static_init_prompt)
-#        logger.debug(f"len {l}, c {c}, max_context_tokens {self.max_context_tokens}")
+        # the static init prompt is not trimmed, it is the static part of the TokenBuffer
         while c > self.max_context_tokens or l > self.max_text_len - 20:
-            t = self.context.trim_words(after=after)
+            t = self.context.trim_words()
             l -= t
             c -= t
             logger.debug(f"len {l}, c {c}, max_context_tokens {self.max_context_tokens}")
             if t == 0:
                 break
 #        logger.debug(f"len {l}, c {c}, max_context_tokens {self.max_context_tokens}")
-        logger.info(f"Context after trim: {self.context.text} (len: {l})")
+        logger.info(f"Context after trim: {self.context.as_text()} (len: {l})")
 
 
-    def logits(self, tokens: torch.Tensor, audio_features: torch.Tensor) -> torch.Tensor:
+    def logits(self, tokens: torch.Tensor, audio_features: torch.Tensor, logits_positions=None) -> torch.Tensor:
+        """logits_positions: positions in tokens to compute the logits for, all of them if None.
+        The projection to the whole vocabulary is expensive, so we request only the positions that are read."""
         if self.cfg.decoder_type == "greedy":
-            logit = self.model.decoder(tokens, audio_features, kv_cache=self.kv_cache)
+            logit = self.decoder(tokens, audio_features, kv_cache=self.kv_cache, logits_positions=logits_positions)
         else:
             logger.debug(f"Logits shape: {tokens.shape}")
-            logit = self.inference.logits(tokens, audio_features)
+            logit = self.inference.logits(tokens, audio_features, logits_positions=logits_positions)
         return logit
     
 
@@ -209,17 +228,26 @@ class PaddedAlignAttWhisper:
         logger.debug("Refreshing segment:")
         self.init_tokens()
         self.last_attend_frame = -self.cfg.rewind_threshold       
-        self.detected_language = None
+        self.language_tracker.new_segment()
+        self.idle_state = None
+        if self.cfg.language == "auto" and self.language_tracker.needs_detection():
+            self.detected_language = None
         self.init_context()
         logger.debug(f"Context: {self.context}")
         if not complete and len(self.segments) > 2:
             logger.debug("keeping last two segments because they are and it is not complete.")
-            self.segments = self.segments[-2:]
+            self.segments.keep_last(2)
         else:
             logger.debug("removing all segments.")
-            self.segments = []
+            self.segments.clear()
         self.log_segments += 1
 
+    def reset_language(self):
+        '''A new session starts, the language is going to be detected again.'''
+        self.language_tracker.reset()
+        if self.cfg.language == "auto":
+            self.detected_language = None
+
 
     def fire_at_boundary(self, chunked_encoder_feature: torch.Tensor):
         if self.always_fire: return True
@@ -243,20 +271,22 @@ class PaddedAlignAttWhisper:
             current_tokens = torch.cat(toks, dim=1)
         else:
             current_tokens = toks[0]
+        if self.decoder_type == "adaptive":
+            # it starts with one hypothesis and widens to beam_size only when it is uncertain
+            current_tokens = current_tokens[:1]
         logger.debug("debug print current_tokens:")
         self.debug_print_tokens(current_tokens)
         return current_tokens
 
 
     def debug_print_tokens(self, tokens):
-        for i in range(self.cfg.beam_size):
+        for i in range(tokens.shape[0]):
             logger.debug(self.tokenizer.decode_with_timestamps(tokens[i].tolist()))
 
     ### audio buffer 
 
     def segments_len(self):
-        segments_len = sum(s.shape[0] for s in self.segments) / 16000
-        return segments_len
+        return self.segments.seconds()
 
     def _apply_minseglen(self):
         segments_len = self.segments_len()
@@ -267,30 +297,65 @@ class PaddedAlignAttWhisper:
         return True
 
     def insert_audio(self, segment=None):
+        '''segment: audio array, or a list of arrays that are one segment together'''
         if segment is not None:
             self.segments.append(segment)
+            last = self.segments.last_segment()
+            if last.shape[0] > 0:
+                self.new_audio_rms = max(self.new_audio_rms, last.square().mean().sqrt().item())
+            self.new_audio_len += last.shape[0] / 16000
+            if self.pending_since is None:
+                self.pending_since = time.monotonic()
 
         removed_len = 0
+        if self.cfg.audio_trim_margin is not None:
+            removed_len += self.trim_audio_by_attention()
         # len of audio is bigger than buffer_len. Going to remove the first segment
-        segments_len = self.segments_len()
-        while len(self.segments) > 1 and segments_len > self.cfg.audio_max_len:
-            removed_len = self.segments[0].shape[0] / 16000
-            segments_len -= removed_len
-            self.last_attend_frame -= int(TOKENS_PER_SECOND*removed_len)
-            self.segments = self.segments[1:]
+        while len(self.segments) > 1 and self.segments_len() > self.cfg.audio_max_len:
+            segment_len = self.segments.pop_first() / 16000
+            removed_len += segment_len
+            self.last_attend_frame -= int(TOKENS_PER_SECOND*segment_len)
             logger.debug(f"remove segments: {len(self.segments)} {len(self.tokens)}")
             if len(self.tokens) > 1:
                 self.context.append_token_ids(self.tokens[1][0,:])
                 self.tokens = [self.initial_tokens] + self.tokens[2:]
+                self.token_positions = self.token_positions[1:]
         return removed_len
 
+    def trim_audio_by_attention(self):
+        '''Removes the audio before the last committed word, except audio_trim_margin seconds. The committed
+        words before it are moved to the context. The position of a word is where its first token attended to.
+        Returns the length of the removed audio in seconds.'''
+        if len(self.tokens) < 2:
+            return 0
+        committed = torch.cat(self.tokens[1:], dim=1)[0].tolist()
+        positions = [p for group in self.token_positions for p in group]
+        _, word_tokens = self.tokenizer.split_to_word_tokens(committed)
+        if len(word_tokens) < 2:
+            return 0
+        first_kept = len(committed) - len(word_tokens[-1])
+        cut = positions[first_kept] - self.segments.evicted - int(self.cfg.audio_trim_margin * 16000)
+        # it is trimmed in whole encoder frames, and at least one frame of audio stays in the buffer
+        samples_per_frame = 16000 // TOKENS_PER_SECOND
+        cut = min(cut, self.segments.num_samples() - samples_per_frame) // samples_per_frame * samples_per_frame
+        if cut <= 0:
+            return 0
+        self.segments.trim_front(cut)
+        self.last_attend_frame -= cut // samples_per_frame
+        self.context.append_token_ids(committed[:first_kept])
+        kept = torch.tensor([committed[first_kept:]], dtype=torch.long, device=self.model.device)
+        self.tokens = [self.initial_tokens, kept.repeat_interleave(self.cfg.beam_size, dim=0)]
+        self.token_positions = [positions[first_kept:]]
+        logger.debug(f"Trimmed {cut/16000:.2f}s of audio and {first_kept} committed tokens by attention")
+        return cut / 16000
+
     def _clean_cache(self):
         '''clean the cache that stores the attention matrices and kv_cache.
         It must be called every time after generation with the model.'''
         # cleaning cache
         self.dec_attns = []
         self.kv_cache = {}
-        if self.decoder_type == "beam":
+        if self.decoder_type in ("beam", "adaptive"):
             self.inference.kv_cache = self.kv_cache
             self.token_decoder.reset()
 
@@ -303,18 +368,17 @@ class PaddedAlignAttWhisper:
         # forward pass using a single token, startoftranscript
         n_audio = encoder_features.shape[0]
         x = torch.tensor([[self.tokenizer.sot]] * n_audio).to(self.model.device)  # [n_audio, 1]
-        logits = self.model.logits(x, encoder_features)[:, 0]
+        # only the columns of the language tokens are computed, instead of suppressing all the others
+        all_language_tokens = list(self.tokenizer.all_language_tokens)
+        logits = self.model.logits(x, encoder_features, logits_positions=[0], logits_tokens=all_language_tokens)[:, 0]
 
-        # collect detected languages; suppress all non-language tokens
-        mask = torch.ones(logits.shape[-1], dtype=torch.bool)
-        mask[list(self.tokenizer.all_language_tokens)] = False
-        logits[:, mask] = -np.inf
-        language_tokens = logits.argmax(dim=-1)
+        # collect detected languages
+        language_tokens = torch.tensor(all_language_tokens, device=logits.device)[logits.argmax(dim=-1)]
         language_token_probs = logits.softmax(dim=-1).cpu()
         language_probs = [
             {
                 c: language_token_probs[i, j].item()
-                for j, c in zip(self.tokenizer.all_language_tokens, self.tokenizer.all_language_codes)
+                for j, c in enumerate(self.tokenizer.all_language_codes)
             }
             for i in range(n_audio)
         ]
@@ -329,8 +393,83 @@ class PaddedAlignAttWhisper:
 
     ### transcription / translation
 
+    def _token_budget(self):
+        '''Max number of new tokens in this decoding, None if it is unlimited.'''
+        if self.cfg.max_tokens_per_second <= 0:
+            return None
+        # the decoding can be called also without new audio, e.g. at the end
+        seconds = max(self.new_audio_len, self.cfg.segment_length)
+        return math.ceil(self.cfg.max_tokens_per_second * seconds)
+
+    def _decoding_state(self, is_last):
+        '''Everything that the result of the decoding depends on, except the model.'''
+        return (self.segments.version, sum(t.shape[1] for t in self.tokens), self.context.num_tokens(),
+                self.last_attend_frame, self.detected_language, is_last)
+
+    def _skip_decoding(self, state):
+        if state == self.idle_state:
+            # the decoding is deterministic, so it would commit nothing again
+            logger.debug("Nothing changed since the last decoding that committed nothing, skipping it.")
+            return True
+        if not state[-1] and self.cfg.silence_rms > 0 and self.new_audio_rms < self.cfg.silence_rms:
+            # the audio stays in the buffer, it is decoded with the next non-silent audio
+            logger.debug(f"The new audio is silent (rms {self.new_audio_rms:.5f}), the decoding is deferred.")
+            return True
+        return False
+
+    def encode(self, input_segments):
+        '''Returns the length of the audio in encoder frames, and the encoder features. A generator, like decode().
+        They are cached while the audio buffer does not change, e.g. when finishing without new audio.'''
+        if self.encoder_cache is not None and self.encoder_cache[0] == self.segments.version:
+            logger.debug("Reusing the encoder features.")
+            return self.encoder_cache[1:]
+
+        with metrics.stage_seconds.time(stage="mel"):
+            # mel + padding to 30s
+            mel_padded = log_mel_spectrogram(input_segments, n_mels=self.model.dims.n_mels, padding=N_SAMPLES, 
+                                                device=self.model.device).unsqueeze(0)
+            # trim to 3000
+            mel = pad_or_trim(mel_padded, N_FRAMES)
+
+        # the len of actual audio
+        content_mel_len = int((mel_padded.shape[2] - mel.shape[2])/2)
+
+        # encode
+        encoder_feature = yield ("encode", mel)
+        self.encoder_cache = (self.segments.version, content_mel_len, encoder_feature)
+        return content_mel_len, encoder_feature
+
     @torch.no_grad()
     def infer(self, is_last=False):
+        if self.shared.scheduler is not None:
+            # the forward passes are batched with the other sessions
+            return self.shared.scheduler.infer(self, is_last)
+        # the model is shared with the other sessions, they decode one after another
+        with self.shared.use(self):
+            steps = self.decode(is_last)
+            try:
+                request = next(steps)
+                while True:
+                    request = steps.send(self.forward(request))
+            except StopIteration as e:
+                return e.value
+
+    def forward(self, request):
+        '''Runs a forward pass requested by decode(): ("encode", mel) or ("logits", tokens, audio_features,
+        logits_positions).'''
+        if request[0] == "encode":
+            with metrics.stage_seconds.time(stage="encoder"):
+                return self.encoder(request[1])
+        with metrics.stage_seconds.time(stage="decoder_step"):
+            return self.logits(*request[1:])
+
+    @torch.no_grad()
+    def decode(self, is_last):
+        '''The decoding of infer(), as a generator. It yields the forward passes of the model as requests for
+        forward(), and it receives their results, so that they can be batched with other sessions. It returns the
+        new tokens and the generation progress.'''
+        # imported here, not at the module level, because whisper.timing imports numba, which is slow
+        from .whisper.timing import median_filter
         new_segment = True
         if len(self.segments) == 0:
             logger.debug("No segments, nothing to do")
@@ -338,29 +477,25 @@ class PaddedAlignAttWhisper:
             return [], {}
         if not self._apply_minseglen():
             logger.debug(f"applied minseglen {self.cfg.audio_min_len} > {self.segments_len()}.")
-            input_segments = torch.cat(self.segments, dim=0)
-            self.logdir_save(input_segments, [], {})
+            self.logdir_save(self.segments.audio(), [], {})
             return [], {}
 
-        # input_segments is concatenation of audio, it's one array
-        if len(self.segments) > 1:
-            input_segments = torch.cat(self.segments, dim=0)
-        else:
-            input_segments = self.segments[0]
-
-
-        
-        # mel + padding to 30s
-        mel_padded = log_mel_spectrogram(input_segments, n_mels=self.model.dims.n_mels, padding=N_SAMPLES, 
-                                            device=self.model.device).unsqueeze(0)
-        # trim to 3000
-        mel = pad_or_trim(mel_padded, N_FRAMES)
+        # input_segments is all the audio, it's a contiguous view of the buffer
+        input_segments = self.segments.audio()
 
-        # the len of actual audio
-        content_mel_len = int((mel_padded.shape[2] - mel.shape[2])/2)
+        state_before = self._decoding_state(is_last)
+        if self._skip_decoding(state_before):
+            # the same state as when the decoding commits nothing
+            self.tokens.append(torch.zeros((self.cfg.beam_size, 0), dtype=torch.long, device=self.model.device))
+            self.token_positions.append([])
+            self.logdir_save(input_segments, [], {})
+            return [], {}
+        self.new_audio_rms = 0.0
+        token_budget = self._token_budget()
+        self.new_audio_len = 0.0
+        self.pending_since = None
 
-        # encode
-        encoder_feature = self.model.encoder(mel)
+        content_mel_len, encoder_feature = yield from self.encode(input_segments)
 
 #        logger.debug(f"Encoder feature shape: {encoder_feature.shape}")
 #        if mel.shape[-2:] != (self.model.dims.n_audio_ctx, self.model.dims.n_audio_state):
@@ -372,9 +507,10 @@ class PaddedAlignAttWhisper:
             logger.info(f"Detected language: {top_lan} with p={p:.4f}")
             #self.tokenizer.language = top_lan
             #self.tokenizer.__post_init__()
-            self.create_tokenizer(top_lan)
+            if self.language_tracker.update(top_lan, p):
+                self.create_tokenizer(top_lan)
+                self.init_tokens()
             self.detected_language = top_lan
-            self.init_tokens()
             logger.info(f"Tokenizer language: {self.tokenizer.language}, {self.tokenizer.sot_sequence_including_notimestamps}")
 
         self.trim_context()
@@ -386,13 +522,16 @@ class PaddedAlignAttWhisper:
         ####################### Decoding loop
         logger.info("Decoding loop starts\n")
 
-        sum_logprobs = torch.zeros(self.cfg.beam_size, device=mel.device)
+        sum_logprobs = torch.zeros(self.cfg.beam_size, device=self.model.device)
         completed = False
 
         attn_of_alignment_heads = None
         most_attended_frame = None
+        attended_frames = []  # of the top hypothesis, for every generated token
 
         token_len_before_decoding = current_tokens.shape[1]
+        if self.decoder_type == "adaptive":
+            saved_beam_steps_before = self.token_decoder.saved_beam_steps
         
         generation_progress = []
         generation = {
@@ -411,27 +550,34 @@ class PaddedAlignAttWhisper:
 
             # to be filled in the loop
             "progress": generation_progress,
+
+            # "budget" or "repetition" if the decoding was stopped early
+            "stopped": None,
         }
         while not completed and current_tokens.shape[1] < self.max_text_len: # bos is 3 tokens
             generation_progress_loop = []
 
             if new_segment:
                 tokens_for_logits = current_tokens
+                # only the sot position (for no_speech prob) and the last one are read
+                logits_positions = [self.sot_index, -1]
             else:
                 # only need to use the last token except in the first forward pass
                 tokens_for_logits = current_tokens[:,-1:]
+                logits_positions = None
 
-            logits = self.logits(tokens_for_logits, encoder_feature) # B, len(tokens), token dict size
+            logits = yield ("logits", tokens_for_logits, encoder_feature, logits_positions) # B, len(logits_positions), token dict size
             if new_segment:
                 generation["logits_starting"] = Logits(logits[:,:,:])
 
             if new_segment and self.tokenizer.no_speech is not None:
-                probs_at_sot = logits[:, self.sot_index, :].float().softmax(dim=-1)
+                probs_at_sot = logits[:, 0, :].float().softmax(dim=-1)  # 0 is self.sot_index in logits_positions
                 no_speech_probs = probs_at_sot[:, self.tokenizer.no_speech].tolist()
                 generation["no_speech_prob"] = no_speech_probs[0]
                 if no_speech_probs[0] > self.cfg.nonspeech_prob:
                     generation["no_speech"] = True
                     logger.info("no speech, stop")
+                    metrics.decoding_stops.inc(reason="no_speech")
                     break
 
             logits = logits[:, -1, :] # logits for the last token
@@ -439,7 +585,7 @@ class PaddedAlignAttWhisper:
 
             # supress blank tokens only at the beginning of the segment
             if new_segment:
-                logits[:, self.tokenizer.encode(" ") + [self.tokenizer.eot]] = -np.inf
+                logits[:, self.blank_tokens] = -np.inf
             new_segment = False
             self.suppress_tokens(logits)
             #generation_progress_loop.append(("logits_after_suppres",BeamLogits(logits[0,:].clone(), self.cfg.beam_size)))
@@ -466,18 +612,21 @@ class PaddedAlignAttWhisper:
 
             #     logger.debug("decode stopped because decoder completed")
 
+            alignment_start = time.perf_counter()
             attn_of_alignment_heads = [[] for _ in range(self.num_align_heads)]
+            # number of hypotheses in the last forward pass. With the adaptive decoder, it changes between 1 and beam_size.
+            n_rows = self.dec_attns[-1].shape[0] if self.dec_attns[-1].dim() == 4 else 1
             for i, attn_mat in enumerate(self.dec_attns):
                 layer_rank = int(i % len(self.model.decoder.blocks))
                 align_heads_in_layer = self.align_source.get(layer_rank, [])
                 if len(align_heads_in_layer) == 0:
                     continue
                 for align_head_rank, head_id in align_heads_in_layer:
-                    if self.cfg.beam_size == 1:
+                    if attn_mat.dim() == 3:  # one hypothesis, squeezed in layer_hook
                         a = attn_mat[head_id, :, :]
-                        a = a.unsqueeze(0)
+                        a = a.unsqueeze(0).expand(n_rows, -1, -1)
                     else:
-                        a = attn_mat[:, head_id, :, :]
+                        a = attn_mat[:n_rows, head_id, :, :]
                     attn_of_alignment_heads[align_head_rank].append(a)
             tmp = []
             for mat in attn_of_alignment_heads:
@@ -499,6 +648,8 @@ class PaddedAlignAttWhisper:
             logger.debug(str(most_attended_frames.tolist()) + " most att frames")
 
             most_attended_frame = most_attended_frames[0].item()
+            attended_frames.append(most_attended_frame)
+            metrics.stage_seconds.observe(time.perf_counter() - alignment_start, stage="alignment")
 
 
             generation_progress.append(dict(generation_progress_loop))
@@ -519,6 +670,7 @@ class PaddedAlignAttWhisper:
                         f"[rewind detected] current attention pos: {most_attended_frame}, "
                         f"last attention pos: {self.last_attend_frame}; omit this segment")
                     self.last_attend_frame = -self.cfg.rewind_threshold
+                    metrics.decoding_stops.inc(reason="rewind")
                     current_tokens = torch.cat(self.tokens, dim=1) if len(self.tokens) > 0 else self.tokens[0]
                     break
             else:
@@ -529,9 +681,32 @@ class PaddedAlignAttWhisper:
                 # stripping the last token, the one that is attended too close to the end
                 current_tokens = current_tokens[:, :-1]
                 break
+
+            new_tokens_len = current_tokens.shape[1] - token_len_before_decoding
+            if self.cfg.repetition_count > 0:
+                tail_start = max(token_len_before_decoding,
+                                 current_tokens.shape[1] - self.cfg.repetition_ngram * self.cfg.repetition_count)
+                n = repeated_ngram_len(current_tokens[0, tail_start:].tolist(),
+                                       self.cfg.repetition_ngram, self.cfg.repetition_count)
+                if n > 0:
+                    # the first occurrence of the n-gram is kept, the looping tail is discarded
+                    discarded = n * (self.cfg.repetition_count - 1)
+                    logger.info(f"Repetition loop of a {n}-gram detected, discarding {discarded} tokens")
+                    current_tokens = current_tokens[:, :-discarded]
+                    generation["stopped"] = "repetition"
+                    self.decode_stats["repetition_stops"] += 1
+                    metrics.decoding_stops.inc(reason="repetition")
+                    self.decode_stats["repetition_discarded_tokens"] += discarded
+                    break
+            if token_budget is not None and new_tokens_len >= token_budget:
+                logger.info(f"Decoding budget of {token_budget} tokens reached")
+                generation["stopped"] = "budget"
+                self.decode_stats["budget_stops"] += 1
+                metrics.decoding_stops.inc(reason="budget")
+                break
         
             # debug print
-            for i in range(self.cfg.beam_size):
+            for i in range(min(current_tokens.shape[0], len(most_attended_frames))):
                 logger.debug("attn: {}, current pos: {}, current token: {}({})".format(
                     attn_of_alignment_heads.shape if attn_of_alignment_heads is not None else None,
                     most_attended_frames[i], 
@@ -550,6 +725,13 @@ class PaddedAlignAttWhisper:
         ####################### End of decoding loop
 
         logger.info("End of decoding loop")
+        if self.cfg.language == "auto":
+            # sum_logprobs of the top hypothesis over the decoding steps
+            self.language_tracker.report_confidence(sum_logprobs[0].item(), len(generation_progress))
+        if self.decoder_type == "adaptive":
+            generation["saved_beam_steps"] = self.token_decoder.saved_beam_steps - saved_beam_steps_before
+            logger.info(f"Adaptive beam saved {generation['saved_beam_steps']} beam-steps in this iteration, "
+                        f"{self.token_decoder.saved_beam_steps} in total")
 
         # if attn_of_alignment_heads is not None:
         #     seg_len = int(segment.shape[0] / 16000 * TOKENS_PER_SECOND)
@@ -594,6 +776,9 @@ class PaddedAlignAttWhisper:
             device=self.model.device,
         )
         self.tokens.append(new_tokens)
+        samples_per_frame = 16000 // TOKENS_PER_SECOND
+        self.token_positions.append([f * samples_per_frame + self.segments.evicted
+                                     for f in attended_frames[:len(new_hypothesis)]])
         # TODO: test if this is redundant or not
 #        ret = ret[ret<DEC_PAD]
 
@@ -601,6 +786,8 @@ class PaddedAlignAttWhisper:
         
         self._clean_cache()
 
+        if not new_hypothesis and self._decoding_state(is_last) == state_before:
+            self.idle_state = state_before
         self.logdir_save(input_segments, new_hypothesis, generation)
         return new_hypothesis, generation
 
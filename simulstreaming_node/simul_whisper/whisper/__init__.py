@@ -11,7 +11,6 @@ from tqdm import tqdm
 from .audio import load_audio, log_mel_spectrogram, pad_or_trim
 from .decoding import DecodingOptions, DecodingResult, decode, detect_language
 from .model import ModelDimensions, Whisper
-from .transcribe import transcribe
 from .version import __version__
 
 _MODELS = {
@@ -51,6 +50,17 @@ _ALIGNMENT_HEADS = {
 }
 
 
+def __getattr__(name):
+    # transcribe is imported on first use, because it imports numba for the word timing, which is slow
+    if name == "transcribe":
+        from .transcribe import transcribe
+
+        # importing the submodule has set the package attribute to the module, not the function
+        globals()["transcribe"] = transcribe
+        return transcribe
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
 def _download(url: str, root: str, in_memory: bool) -> Union[bytes, str]:
     os.makedirs(root, exist_ok=True)
 
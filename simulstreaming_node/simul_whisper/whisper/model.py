@@ -2,7 +2,7 @@ import base64
 import gzip
 from contextlib import contextmanager
 from dataclasses import dataclass
-from typing import Dict, Iterable, Optional, Tuple
+from typing import Dict, Iterable, Optional, Sequence, Tuple
 
 import numpy as np
 import torch
@@ -11,7 +11,6 @@ from torch import Tensor, nn
 
 from .decoding import decode as decode_function
 from .decoding import detect_language as detect_language_function
-from .transcribe import transcribe as transcribe_function
 
 
 try:
@@ -255,12 +254,26 @@ class TextDecoder(nn.Module):
         mask = torch.empty(n_ctx, n_ctx).fill_(-np.inf).triu_(1)
         self.register_buffer("mask", mask, persistent=False)
 
-    def forward(self, x: Tensor, xa: Tensor, kv_cache: Optional[dict] = None):
+    def forward(
+        self,
+        x: Tensor,
+        xa: Tensor,
+        kv_cache: Optional[dict] = None,
+        logits_positions: Optional[Sequence[int]] = None,
+        logits_tokens: Optional[Sequence[int]] = None,
+    ):
         """
         x : torch.LongTensor, shape = (batch_size, <= n_ctx)
             the text tokens
         xa : torch.Tensor, shape = (batch_size, n_audio_ctx, n_audio_state)
             the encoded audio features to be attended on
+        logits_positions : Sequence[int], optional
+            positions in x (negative indices allowed) to compute the logits for;
+            the output is then of shape (batch_size, len(logits_positions), n_vocab).
+            If None, the logits are computed for all positions.
+        logits_tokens : Sequence[int], optional
+            token ids to compute the logits for, e.g. the language tokens;
+            the last dimension of the output is then len(logits_tokens) instead of n_vocab.
         """
 
         offset = next(iter(kv_cache.values())).shape[1] if kv_cache else 0
@@ -276,8 +289,14 @@ class TextDecoder(nn.Module):
             x = block(x, xa, mask=self.mask, kv_cache=kv_cache)
             i += 1
 
+        if logits_positions is not None:
+            # the projection to the vocabulary is the most expensive part for long prompts
+            x = x[:, list(logits_positions)]
         x = self.ln(x)
-        logits = x @ torch.transpose(self.token_embedding.weight, 0, 1)
+        weight = self.token_embedding.weight
+        if logits_tokens is not None:
+            weight = weight[list(logits_tokens)]
+        logits = x @ torch.transpose(weight, 0, 1)
 
         return logits
 
@@ -301,8 +320,9 @@ class Whisper(nn.Module):
             self.dims.n_text_layer,
         )
         # use the last half layers for alignment by default; see `set_alignment_heads()` below
+        # on CPU also when the model is constructed on the meta device, to_sparse has no meta kernel
         all_heads = torch.zeros(
-            self.dims.n_text_layer, self.dims.n_text_head, dtype=torch.bool
+            self.dims.n_text_layer, self.dims.n_text_head, dtype=torch.bool, device="cpu"
         )
         all_heads[self.dims.n_text_layer // 2 :] = True
         self.register_buffer("alignment_heads", all_heads.to_sparse(), persistent=False)
@@ -319,10 +339,16 @@ class Whisper(nn.Module):
     def embed_audio(self, mel: torch.Tensor):
         return self.encoder(mel)
 
-    def logits(self, tokens: torch.Tensor, audio_features: torch.Tensor):
+    def logits(
+        self,
+        tokens: torch.Tensor,
+        audio_features: torch.Tensor,
+        logits_positions: Optional[Sequence[int]] = None,
+        logits_tokens: Optional[Sequence[int]] = None,
+    ):
         # tokens = tokens.to(self.decoder.ln.weight.dtype)
         # audio_features = audio_features.to(self.decoder.ln.weight.dtype)
-        return self.decoder(tokens, audio_features)
+        return self.decoder(tokens, audio_features, logits_positions=logits_positions, logits_tokens=logits_tokens)
 
     def forward(
         self, mel: torch.Tensor, tokens: torch.Tensor
@@ -377,6 +403,12 @@ class Whisper(nn.Module):
         self.decoder.apply(install_hooks)
         return cache, hooks
 
+    def transcribe(self, *args, **kwargs):
+        # imported on first use, because it imports numba, which is slow. Not from the package, where the attribute
+        # is the submodule once it has been imported directly.
+        from .transcribe import transcribe as transcribe_function
+
+        return transcribe_function(self, *args, **kwargs)
+
     detect_language = detect_language_function
-    transcribe = transcribe_function
     decode = decode_function
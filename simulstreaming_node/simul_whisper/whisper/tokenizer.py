@@ -1,6 +1,8 @@
 import base64
 import os
+import pickle
 import string
+import tempfile
 from dataclasses import dataclass, field
 from functools import cached_property, lru_cache
 from typing import Dict, List, Optional, Tuple
@@ -283,31 +285,79 @@ class Tokenizer:
 
         return self.split_tokens_on_spaces(tokens)
 
+    @cached_property
+    def _token_bytes(self) -> Dict[int, bytes]:
+        return {}
+
+    @cached_property
+    def _token_punctuation(self) -> Dict[int, bool]:
+        return {}
+
+    def token_bytes(self, token: int) -> bytes:
+        """The bytes of a single token (also special or timestamp). They are cached."""
+        b = self._token_bytes.get(token)
+        if b is None:
+            b = self._token_bytes[token] = self.encoding.decode_single_token_bytes(token)
+        return b
+
     def split_tokens_on_unicode(self, tokens: List[int]):
-        decoded_full = self.decode_with_timestamps(tokens)
+        """
+        Linear-time split: the bytes of every token are looked up once, and a UTF-8 state machine tracks
+        whether the last character is complete. Only an incomplete or invalid sequence is compared with
+        the decoding of all the tokens, to find out whether it will be completed by the next tokens.
+        """
         replacement_char = "\ufffd"
+        decoded_full = None
 
         words = []
         word_tokens = []
         current_tokens = []
+        current_bytes = b""
+        pending = 0  # continuation bytes expected by the last character, -1 after an invalid sequence
         unicode_offset = 0
 
         for token in tokens:
+            token_bytes = self.token_bytes(token)
             current_tokens.append(token)
-            decoded = self.decode_with_timestamps(current_tokens)
-
-            if (
-                replacement_char not in decoded
-                or decoded_full[unicode_offset + decoded.index(replacement_char)]
-                == replacement_char
-            ):
-                words.append(decoded)
-                word_tokens.append(current_tokens)
-                current_tokens = []
-                unicode_offset += len(decoded)
+            current_bytes += token_bytes
+            if pending >= 0:
+                pending = _utf8_pending(token_bytes, pending)
+
+            decoded = None
+            if pending == 0:
+                try:
+                    decoded = current_bytes.decode("utf-8")
+                except UnicodeDecodeError:  # e.g. an overlong or surrogate sequence
+                    pass
+            if decoded is None:
+                decoded = current_bytes.decode("utf-8", errors="replace")
+                if decoded_full is None:
+                    decoded_full = self.decode_with_timestamps(tokens)
+                if not (
+                    replacement_char not in decoded
+                    or decoded_full[unicode_offset + decoded.index(replacement_char)]
+                    == replacement_char
+                ):
+                    continue
+
+            words.append(decoded)
+            word_tokens.append(current_tokens)
+            current_tokens = []
+            current_bytes = b""
+            pending = 0
+            unicode_offset += len(decoded)
 
         return words, word_tokens
 
+    def _is_punctuation(self, subword: str, subword_tokens: List[int]) -> bool:
+        if len(subword_tokens) > 1:
+            return subword.strip() in string.punctuation
+        token = subword_tokens[0]
+        p = self._token_punctuation.get(token)
+        if p is None:
+            p = self._token_punctuation[token] = subword.strip() in string.punctuation
+        return p
+
     def split_tokens_on_spaces(self, tokens: List[int]):
         subwords, subword_tokens_list = self.split_tokens_on_unicode(tokens)
         words = []
@@ -315,8 +365,8 @@ class Tokenizer:
 
         for subword, subword_tokens in zip(subwords, subword_tokens_list):
             special = subword_tokens[0] >= self.eot
-            with_space = subword.startswith(" ")
-            punctuation = subword.strip() in string.punctuation
+            with_space = self.token_bytes(subword_tokens[0]).startswith(b" ")
+            punctuation = self._is_punctuation(subword, subword_tokens)
             if special or with_space or punctuation or len(words) == 0:
                 words.append(subword)
                 word_tokens.append(subword_tokens)
@@ -327,13 +377,73 @@ class Tokenizer:
         return words, word_tokens
 
 
-@lru_cache(maxsize=None)
-def get_encoding(name: str = "gpt2", num_languages: int = 99):
-    vocab_path = os.path.join(os.path.dirname(__file__), "assets", f"{name}.tiktoken")
+def _utf8_pending(data: bytes, pending: int) -> int:
+    """
+    UTF-8 state machine. Returns how many continuation bytes the last character expects after `data`,
+    when `pending` of them were expected before it, or -1 if `data` contains an invalid sequence.
+    """
+    for byte in data:
+        if pending > 0:
+            if byte & 0xC0 != 0x80:
+                return -1
+            pending -= 1
+        elif byte < 0x80:
+            continue
+        elif 0xC2 <= byte <= 0xDF:
+            pending = 1
+        elif 0xE0 <= byte <= 0xEF:
+            pending = 2
+        elif 0xF0 <= byte <= 0xF4:
+            pending = 3
+        else:
+            return -1
+    return pending
+
+
+def _ranks_cache_path(vocab_path: str) -> str:
+    default = os.path.join(os.path.expanduser("~"), ".cache")
+    cache_dir = os.path.join(os.getenv("XDG_CACHE_HOME", default), "whisper")
+    return os.path.join(cache_dir, os.path.basename(vocab_path) + ".pkl")
+
+
+def _load_ranks(vocab_path: str) -> Dict[bytes, int]:
+    """
+    Parses the base64 .tiktoken vocabulary. Parsing it takes most of the tokenizer loading time, so the parsed
+    ranks are cached in a binary (pickle) file in ~/.cache/whisper, which loads several times faster. The cache
+    is valid while the size and modification time of the vocabulary file are the same.
+    """
+    stat = os.stat(vocab_path)
+    key = (stat.st_size, stat.st_mtime_ns)
+    cache_path = _ranks_cache_path(vocab_path)
+    try:
+        with open(cache_path, "rb") as f:
+            cached_key, ranks = pickle.load(f)
+        if cached_key == key:
+            return ranks
+    except (OSError, EOFError, pickle.UnpicklingError, ValueError):
+        pass
+
     ranks = {
         base64.b64decode(token): int(rank)
         for token, rank in (line.split() for line in open(vocab_path) if line)
     }
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        # written to a temporary file and renamed, so that concurrent processes never read a partial cache
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(cache_path))
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump((key, ranks), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        # e.g. a read-only home directory, the vocabulary is parsed again on the next start
+        pass
+    return ranks
+
+
+@lru_cache(maxsize=None)
+def get_encoding(name: str = "gpt2", num_languages: int = 99):
+    vocab_path = os.path.join(os.path.dirname(__file__), "assets", f"{name}.tiktoken")
+    ranks = _load_ranks(vocab_path)
     n_vocab = len(ranks)
     special_tokens = {}
 
@@ -1,4 +1,5 @@
 from whisper_streaming.base import OnlineProcessorInterface, ASRBase
+from whisper_streaming import metrics
 import argparse
 
 import sys
@@ -13,16 +14,50 @@ logger = logging.getLogger(__name__)
 def simulwhisper_args(parser):
     group = parser.add_argument_group('Whisper arguments')
     group.add_argument('--model_path', type=str, default='./large-v3.pt', 
-                        help='The file path to the Whisper .pt model. If not present on the filesystem, the model is downloaded automatically.')
+                        help='The file path to the Whisper .pt model. If not present on the filesystem, the model is downloaded automatically. '
+                        'A .mmap file converted by "python3 -m simul_whisper.mmap_model" is memory-mapped, and its weights are shared '
+                        'by all processes that load it.')
+    group.add_argument("--precision", type=str, default="fp32", choices=["fp32", "bf16", "int8-dynamic"],
+                        help="Precision of the Linear layers of the encoder and decoder, for CPU inference. int8-dynamic is dynamic "
+                        "quantization, CPU only. LayerNorm, the attention softmax and the logits stay in fp32.")
+    group.add_argument("--compile", action=argparse.BooleanOptionalAction, default=False,
+                        help="Compile the encoder and the single-token decoder step with torch.compile. The first iterations are slow "
+                        "because of the compilation.")
+    group.add_argument("--compile_cache_dir", type=str, default=None,
+                        help="Directory to cache the compiled artifacts, so that a warm restart skips the compilation.")
+    group.add_argument("--batch_sessions", type=int, default=1, help="With many concurrent sessions in one process (the server with "
+                        "--max-sessions), run the encoder and the single-token decoder steps of up to this many sessions in one batch. "
+                        "The session with the oldest undecoded audio goes first. 1: the sessions decode one after another.")
     group.add_argument("--beams","-b", type=int, default=1, help="Number of beams for beam search decoding. If 1, GreedyDecoder is used.")
     group.add_argument("--decoder",type=str, default=None, help="Override automatic selection of beam or greedy decoder. "
-                        "If beams > 1 and greedy: invalid.")
+                        "If beams > 1 and greedy: invalid. 'adaptive' decodes greedily while the model is confident, and widens to --beams "
+                        "beams only for uncertain stretches. It requires beams > 1.")
+    group.add_argument("--adaptive_entropy", type=float, default=1.0, help="Entropy threshold (in nats) for --decoder adaptive. "
+                        "The decoding is greedy while the entropy of the next token distribution is at most this value.")
+
+    group.add_argument("--lang_redetect_interval", type=int, default=10, help="With --lan auto, the detected language is kept across "
+                        "segments and detected again after this many segments. 0: only at the start of the session and after low confidence.")
+    group.add_argument("--lang_redetect_logprob", type=float, default=-1.0, help="With --lan auto, the language is detected again in the next "
+                        "segment if the average log probability of the decoded tokens drops below this.")
+
+    group.add_argument("--max_tokens_per_second", type=float, default=0.0, help="Budget of new tokens per second of new audio "
+                        "in one decoding iteration. It stops hallucination loops on noise. 0 is unlimited.")
+    group.add_argument("--repetition_count", type=int, default=0, help="Stop the decoding iteration when an n-gram of up to "
+                        "--repetition_ngram tokens repeats this many times in a row, and discard the repetitions. 0 is off.")
+    group.add_argument("--repetition_ngram", type=int, default=4, help="Max n of the n-grams for --repetition_count.")
 
     group = parser.add_argument_group('Audio buffer')
     group.add_argument('--audio_max_len', type=float, default=30.0, 
                         help='Max length of the audio buffer, in seconds.')
     group.add_argument('--audio_min_len', type=float, default=0.0, 
                         help='Skip processing if the audio buffer is shorter than this length, in seconds. Useful when the --min-chunk-size is small.')
+    group.add_argument('--audio_trim_margin', type=float, default=None, 
+                        help='Trim the audio buffer by the attention of the committed tokens: the audio before the last committed word is '
+                        'removed, except this margin in seconds, and the removed words are moved to the context. The encoder input stays short. '
+                        'By default, the audio is removed only when the buffer is longer than --audio_max_len.')
+    group.add_argument('--silence_rms', type=float, default=0.0, 
+                        help='Defer the decoding while the RMS of the new audio is below this value, e.g. 0.005 for float audio in [-1,1]. '
+                        'The audio stays in the buffer and it is decoded with the next non-silent chunk, or at the end. 0 is off.')
 
 
     group = parser.add_argument_group('AlignAtt argument')
@@ -57,17 +92,22 @@ def simul_asr_factory(args):
             raise ValueError("Invalid 'greedy' decoder type for beams > 1. Use 'beam'.")
         elif decoder is None or decoder == "beam":
             decoder = "beam"
-        else:
-            raise ValueError("Invalid decoder type. Use 'beam' or 'greedy'.")
+        elif decoder != "adaptive":
+            raise ValueError("Invalid decoder type. Use 'beam', 'adaptive' or 'greedy'.")
     else:
         if decoder is None:
             decoder = "greedy"
+        elif decoder == "adaptive":
+            raise ValueError("Invalid 'adaptive' decoder type for beams = 1. Use beams > 1.")
         elif decoder not in ("beam","greedy"):
             raise ValueError("Invalid decoder type. Use 'beam' or 'greedy'.")
         # else: it is greedy or beam, that's ok 
     
     a = { v:getattr(args, v) for v in ["model_path", "cif_ckpt_path", "frame_threshold", "audio_min_len", "audio_max_len", "beams", "task",
-                                       "never_fire", 'init_prompt', 'static_init_prompt', 'max_context_tokens', "logdir"
+                                       "never_fire", 'init_prompt', 'static_init_prompt', 'max_context_tokens', "logdir",
+                                       "adaptive_entropy", "lang_redetect_interval", "lang_redetect_logprob", "silence_rms",
+                                       "max_tokens_per_second", "repetition_count", "repetition_ngram", "audio_trim_margin", "precision", "compile", "compile_cache_dir",
+                                       "batch_sessions",
                                        ]}
     a["language"] = args.lan
     a["segment_length"] = args.min_chunk_size
@@ -75,8 +115,12 @@ def simul_asr_factory(args):
 
     if args.min_chunk_size >= args.audio_max_len:
         raise ValueError("min_chunk_size must be smaller than audio_max_len")
+    if args.repetition_count == 1:
+        raise ValueError("repetition_count must be 0 or at least 2")
     if args.audio_min_len > args.audio_max_len:
         raise ValueError("audio_min_len must be smaller than audio_max_len")
+    if args.batch_sessions > 1 and args.compile:
+        raise ValueError("batch_sessions can't be used with compile, the compiled graphs are for one session")
     logger.info(f"Arguments: {a}")
     asr = SimulWhisperASR(**a)
     return asr, SimulWhisperOnline(asr)
@@ -86,7 +130,10 @@ class SimulWhisperASR(ASRBase):
     sep = " "
 
     def __init__(self, language, model_path, cif_ckpt_path, frame_threshold, audio_max_len, audio_min_len, segment_length, beams, task, 
-                 decoder_type, never_fire, init_prompt, static_init_prompt, max_context_tokens, logdir):
+                 decoder_type, never_fire, init_prompt, static_init_prompt, max_context_tokens, logdir, adaptive_entropy,
+                 lang_redetect_interval, lang_redetect_logprob, silence_rms,
+                 max_tokens_per_second, repetition_count, repetition_ngram,
+                 audio_trim_margin, precision, compile, compile_cache_dir, batch_sessions):
         cfg = AlignAttConfig(
             model_path=model_path, 
             segment_length=segment_length,
@@ -97,6 +144,18 @@ class SimulWhisperASR(ASRBase):
             cif_ckpt_path=cif_ckpt_path,
             decoder_type=decoder_type, #"greedy" if beams==1 else "beam",
             beam_size=beams,
+            adaptive_entropy=adaptive_entropy,
+            lang_redetect_interval=lang_redetect_interval,
+            lang_redetect_logprob=lang_redetect_logprob,
+            silence_rms=silence_rms,
+            max_tokens_per_second=max_tokens_per_second,
+            repetition_count=repetition_count,
+            repetition_ngram=repetition_ngram,
+            audio_trim_margin=audio_trim_margin,
+            precision=precision,
+            compile=compile,
+            compile_cache_dir=compile_cache_dir,
+            batch_sessions=batch_sessions,
             task=task,
             never_fire=never_fire,
             init_prompt=init_prompt,
@@ -116,6 +175,8 @@ class SimulWhisperASR(ASRBase):
         self.model.insert_audio(audio)
         self.model.infer(True)
         self.model.refresh_segment(complete=True)
+        # the language of the warm-up audio should not be kept for the session
+        self.model.reset_language()
     
     def use_vad(self):
         print("VAD not implemented",file=sys.stderr)
@@ -145,6 +206,9 @@ class SimulWhisperOnline(OnlineProcessorInterface):
         self.audio_bufer_offset = self.offset
         self.last_ts = (-1,-1)
         self.model.refresh_segment(complete=True)
+        if offset is None:
+            # a new session, not a new voiced segment of the same session
+            self.model.reset_language()
 
         self.unicode_buffer = []  # hide incomplete unicode character for the next iteration
 
@@ -166,12 +230,13 @@ class SimulWhisperOnline(OnlineProcessorInterface):
             a = [frames[0]] * len(self.unicode_buffer)
             frames = a + frames
             
-        tokens = tokens.copy()
         ret = []
+        i = 0
         for sw,st in zip(split_words,split_tokens):
             b = None
             for stt in st:
-                t,f = tokens.pop(0), frames.pop(0)
+                t,f = tokens[i], frames[i]
+                i += 1
                 if t != stt:
                     raise ValueError(f"Token mismatch: {t} != {stt} at frame {f}.")
                 if b is None:
@@ -200,24 +265,25 @@ class SimulWhisperOnline(OnlineProcessorInterface):
         return tokens
 
     def process_iter(self):
-        if len(self.audio_chunks) == 0:
+        # the chunks are one segment, they are copied to the model's audio buffer without concatenation
+        audio_len = sum(c.shape[0] for c in self.audio_chunks)
+        if audio_len == 0:
             audio = None
         else:
-            audio = torch.cat(self.audio_chunks, dim=0)
-            if audio.shape[0] == 0:
-                audio = None
-            else:
-                self.end += audio.shape[0] / self.SAMPLING_RATE
+            audio = self.audio_chunks
+            self.end += audio_len / self.SAMPLING_RATE
         self.audio_chunks = []
         self.audio_bufer_offset += self.model.insert_audio(audio)
         tokens, generation_progress = self.model.infer(is_last=self.is_last)
 
-        tokens = self.hide_incomplete_unicode(tokens)
+        with metrics.stage_seconds.time(stage="tokenizer"):
+            tokens = self.hide_incomplete_unicode(tokens)
 
-        # word-level timestamps
-        ts_words = self.timestamped_text(tokens, generation_progress)
+            # word-level timestamps
+            ts_words = self.timestamped_text(tokens, generation_progress)
 
-        text = self.model.tokenizer.decode(tokens)
+            text = self.model.tokenizer.decode(tokens)
+        metrics.tokens.inc(len(tokens))
 
         if len(text) == 0:
             return (None,None,"")
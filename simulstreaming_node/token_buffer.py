@@ -1,37 +1,74 @@
 import torch
 import sys
+from collections import deque
+
 class TokenBuffer:
+    '''Context for the decoder: the text that is stored as token ids split into words.
+
+    The token ids are stored natively, so the context is not re-tokenized in every iteration. Appending token ids
+    is O(new tokens), trimming a word from the front is O(1), and the tensors for the decoder are cached until
+    the buffer changes.
+
+    static_text: it is never trimmed, e.g. the static prompt with terminology.
+    '''
 
-    def __init__(self, text="", tokenizer=None, device=None, prefix_token_ids=[]):
-        self.text = text
+    def __init__(self, text="", tokenizer=None, device=None, prefix_token_ids=[], static_text=""):
         self.prefix_token_ids = prefix_token_ids
         self.tokenizer = tokenizer
         self.device = device
 
+        self.static_token_ids = self._encode(static_text) if static_text else []
+        self.words = deque()  # token ids of every word that can be trimmed
+        self.num_word_tokens = 0
+        self._changed()
+        if text:
+            self.append_text(text)
+
+    def _encode(self, text):
+        if self.tokenizer is None:
+            raise ValueError("Tokenizer is not set.")
+        return self.tokenizer.encode(text)
+
+    def _changed(self):
+        # invalidate the cached ids, text and tensors
+        self._token_ids = None
+        self._text = None
+        self._tensors = {}
+
     def as_token_ids(self, tokenizer=None):
+        '''The returned list is cached, it should not be modified.'''
+        if self._token_ids is None:
+            self._token_ids = self.prefix_token_ids + self.static_token_ids + [t for w in self.words for t in w]
+        return self._token_ids
 
-        if tokenizer is None:
-            tokenizer = self.tokenizer
-        if tokenizer is None:
-            raise ValueError("Tokenizer is not set.") 
-        return self.prefix_token_ids + tokenizer.encode(self.text)
+    def num_tokens(self):
+        '''number of tokens without the prefix'''
+        return len(self.static_token_ids) + self.num_word_tokens
 
     def as_tensor(self, device=None):
+        return self.as_tensor_beam(1, device=device)
+
+    def as_tensor_beam(self, beam, device=None):
         if device is None:
             device = self.device
         if device is None:
             raise ValueError("Device is not set.")
-        tok_ids = self.as_token_ids()
-        return torch.tensor(tok_ids, 
-                     dtype=torch.long, device=device).unsqueeze(0)
-
-    def as_tensor_beam(self, beam, device=None):
-        t = self.as_tensor(device=device)
-        return t.repeat_interleave(beam, dim=0)
-
+        key = (beam, str(device))
+        if key not in self._tensors:
+            t = torch.tensor(self.as_token_ids(), dtype=torch.long, device=device).unsqueeze(0)
+            self._tensors[key] = t.repeat_interleave(beam, dim=0)
+        return self._tensors[key]
 
     def as_text(self):
-        return self.text
+        if self._text is None:
+            tokenizer = self.tokenizer
+            assert tokenizer is not None, "Tokenizer is not set."
+            self._text = tokenizer.decode(self.static_token_ids + [t for w in self.words for t in w])
+        return self._text
+
+    @property
+    def text(self):
+        return self.as_text()
 
     @staticmethod
     def empty(*a, **kw):
@@ -40,34 +77,51 @@ class TokenBuffer:
     @staticmethod
     def from_text(text, *a, **kw):
         return TokenBuffer(*a, text=text, **kw)
-    
+
     def is_empty(self):
-        return self.text is None or self.text == ""
+        return not self.static_token_ids and not self.words
 
-    def trim_words(self, num=1, after=0):
+    def trim_words(self, num=1):
         '''
-        num: how many words to trim from the beginning
-        after: how many characters to skip (length of the static prompt)
+        num: how many words to trim from the beginning. The static text is not trimmed.
+        Returns the number of trimmed tokens.
         '''
-        tokenizer = self.tokenizer
-        assert tokenizer is not None, "Tokenizer is not set."
+        removed = 0
+        for _ in range(num):
+            if not self.words:
+                break
+            removed += len(self.words.popleft())
+        if removed:
+            self.num_word_tokens -= removed
+            self._changed()
+        return removed
 
-        ids = tokenizer.encode(self.text[after:])
-        words, wids = self.tokenizer.split_to_word_tokens(ids)
-#        print(words, file=sys.stderr)
-#        print(wids, file=sys.stderr)
-        if not words:
-            return 0
-        self.text = self.text[:after] + "".join(words[num:])
-        return sum(len(wi) for wi in wids[:num])
+    def append_text(self, text):
+        self.append_token_ids(self._encode(text))
 
     def append_token_ids(self, token_ids):
         tokenizer = self.tokenizer
         assert tokenizer is not None, "Tokenizer is not set."
-        self.text += self.tokenizer.decode(token_ids)
+        if torch.is_tensor(token_ids):
+            token_ids = token_ids.tolist()
+        # special and timestamp tokens are not part of the text
+        token_ids = [t for t in token_ids if t < tokenizer.eot]
+        if not token_ids:
+            return
+        # the new tokens may continue the last word, so it is split again together with them
+        if self.words:
+            last = self.words.pop()
+            self.num_word_tokens -= len(last)
+            token_ids = last + token_ids
+        _, word_tokens = tokenizer.split_to_word_tokens(token_ids)
+        for wt in word_tokens:
+            self.words.append(wt)
+            self.num_word_tokens += len(wt)
+        self._changed()
 
     def as_split_word_tokens(self):
+        '''words and their token ids, without the static text'''
         tokenizer = self.tokenizer
         assert tokenizer is not None, "Tokenizer is not set."
-        ids = tokenizer.encode(self.text)
-        return tokenizer.split_to_word_tokens(ids)
+        words = [tokenizer.decode(w) for w in self.words]
+        return words, [list(w) for w in self.words]
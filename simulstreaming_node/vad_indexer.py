@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+
+# Batch VAD indexer: finds the speech segments of many audio files with FixedVADIterator, in a pool of processes,
+# and writes a VAD index next to every file (see whisper_streaming/vad_index.py). The simulation from file
+# (simulstreaming_whisper.py --vad-index) and compare_precision.py read the indexes to skip the non-speech audio.
+#
+# Example:
+#   python3 vad_indexer.py archive/*.wav --vac-backend silero --vac-model-path silero_vad.jit --jobs 8
+
+import os
+import sys
+import time
+import logging
+import argparse
+from multiprocessing import Pool
+
+from whisper_streaming.vad_backends import VAD_BACKENDS, load_vad_model
+from whisper_streaming.silero_vad_iterator import FixedVADIterator
+from whisper_streaming.vad_index import default_index_path, find_speech_segments, write_vad_index
+from whisper_streaming.whisper_online_main import load_audio
+
+logger = logging.getLogger(__name__)
+
+SAMPLING_RATE = 16000
+
+# the VAD of the worker process, loaded once by init_worker
+vad = None
+
+
+def init_worker(backend, model_path):
+    global vad
+    import torch
+    # the processes are the parallelism, the threads of every one would compete with the others
+    torch.set_num_threads(1)
+    vad = FixedVADIterator(load_vad_model(backend, model_path))
+
+
+def index_file(job):
+    '''Returns (audio_path, number of segments, seconds of speech, seconds of audio), or the exception.'''
+    audio_path, index_path, backend = job
+    try:
+        audio = load_audio(audio_path)
+        load_audio.cache_clear()  # every file is read once, the cache would only keep it in the memory
+        segments = find_speech_segments(audio, vad)
+        write_vad_index(index_path, segments, len(audio), backend, SAMPLING_RATE)
+        speech = sum(end - beg for beg, end in segments) / SAMPLING_RATE
+        return audio_path, len(segments), speech, len(audio) / SAMPLING_RATE
+    except Exception as e:
+        return audio_path, e
+
+
+def is_up_to_date(audio_path, index_path):
+    return os.path.isfile(index_path) and os.path.getmtime(index_path) >= os.path.getmtime(audio_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Writes the VAD index of every audio file.")
+    parser.add_argument("audio_paths", nargs="*", help="Audio files, 16kHz mono wav or any format that librosa reads.")
+    parser.add_argument("--file-list", type=str, default=None, help="File with one audio path per line.")
+    parser.add_argument("--out-dir", type=str, default=None, help="Directory for the indexes. Default: next to the audio.")
+    parser.add_argument("--jobs", "-j", type=int, default=os.cpu_count(), help="Number of worker processes.")
+    parser.add_argument("--force", action="store_true", default=False, help="Index also the files with an up-to-date index.")
+    parser.add_argument('--vac-backend', type=str, default="silero", choices=list(VAD_BACKENDS))
+    parser.add_argument('--vac-model-path', type=str, default=None,
+                        help="Path to a local VAD model file. Recommended, otherwise every worker loads Silero from torch.hub.")
+    parser.add_argument("-l", "--log-level", dest="log_level", default="INFO",
+                        choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'])
+    args = parser.parse_args()
+    logging.basicConfig(format='%(levelname)s\t%(message)s', level=args.log_level)
+
+    audio_paths = list(args.audio_paths)
+    if args.file_list is not None:
+        with open(args.file_list) as f:
+            audio_paths += [line.strip() for line in f if line.strip()]
+    if args.out_dir is not None:
+        os.makedirs(args.out_dir, exist_ok=True)
+
+    jobs = []
+    for audio_path in audio_paths:
+        index_path = default_index_path(audio_path, args.out_dir)
+        if not args.force and is_up_to_date(audio_path, index_path):
+            logger.debug(f"{index_path} is up to date")
+            continue
+        jobs.append((audio_path, index_path, args.vac_backend))
+    logger.info(f"Indexing {len(jobs)} files, {len(audio_paths) - len(jobs)} are up to date.")
+
+    start = time.time()
+    total_audio = total_speech = 0
+    failed = 0
+    with Pool(args.jobs, initializer=init_worker, initargs=(args.vac_backend, args.vac_model_path)) as pool:
+        for result in pool.imap_unordered(index_file, jobs):
+            if isinstance(result[1], Exception):
+                logger.error(f"{result[0]}: {result[1]!r}")
+                failed += 1
+                continue
+            audio_path, n, speech, duration = result
+            total_audio += duration
+            total_speech += speech
+            logger.info(f"{audio_path}: {n} segments, {speech:.1f} s of speech in {duration:.1f} s")
+    elapsed = time.time() - start
+    logger.info(f"Indexed {len(jobs) - failed} files, {total_audio:.1f} s of audio with {total_speech:.1f} s of speech, "
+                f"in {elapsed:.1f} s ({total_audio / max(elapsed, 1e-9):.0f}x real time).")
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
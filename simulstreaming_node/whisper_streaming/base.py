@@ -43,4 +43,8 @@ class OnlineProcessorInterface:
         raise NotImplementedError("must be implemented in child class")
     
     def finish(self):
-        raise NotImplementedError("must be implemented in child class")
\ No newline at end of file
+        raise NotImplementedError("must be implemented in child class")
+
+    def close(self):
+        '''The session has ended, the processor is idle until the next init().'''
+        pass
\ No newline at end of file
@@ -0,0 +1,138 @@
+import time
+import logging
+import threading
+from functools import lru_cache
+
+import numpy as np
+
+from whisper_streaming.vad_backends import load_vad_model, batched
+
+logger = logging.getLogger(__name__)
+
+# VAD of many concurrent sessions in one process (e.g. one VACOnlineASRProcessor per client connection), evaluated
+# in batches: one forward pass of the VAD model over the next window of every session that is waiting, each with
+# its own recurrent state. With batch size 1, the cost of a Silero call is mostly the per-call overhead, so the cost
+# per session drops with the number of sessions in a batch.
+
+
+class VADSession:
+    '''A VAD model of one session for FixedVADIterator. A call blocks until the batch with its window is evaluated.'''
+
+    def __init__(self, service):
+        self.service = service
+        self.state = None
+        self.active = False
+        self.open()
+
+    def reset_states(self):
+        self.state = None
+
+    def __call__(self, x, sr: int):
+        return self.service.evaluate(self, x, sr)
+
+    def open(self):
+        '''The session takes part in the batches again, after close().'''
+        if not self.active:
+            self.active = True
+            self.service.open_session(self)
+
+    def close(self):
+        '''The session is idle, the batches don't wait for it.'''
+        if self.active:
+            self.active = False
+            self.service.close_session(self)
+
+
+class _Request:
+    def __init__(self, session, window):
+        self.session = session
+        self.window = window
+        self.done = threading.Event()
+        self.prob = None
+        self.error = None
+
+
+class BatchedVAD:
+    '''Evaluates the windows of all sessions in batches, in a worker thread.
+
+    A batch is evaluated when every open session has a window waiting, when max_batch windows are waiting, or
+    max_wait seconds after the first one arrived, so an idle session delays the others by at most max_wait.
+    '''
+
+    def __init__(self, model, sampling_rate=16000, max_batch=64, max_wait=0.002):
+        self.model = batched(model)
+        self.sampling_rate = sampling_rate
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+
+        self.condition = threading.Condition()
+        self.pending = []
+        self.num_sessions = 0  # the active ones, a batch waits for their windows
+        self.batches = 0
+        self.windows = 0
+
+        self.worker = threading.Thread(target=self.run, daemon=True, name="BatchedVAD")
+        self.worker.start()
+
+    def session(self):
+        return VADSession(self)
+
+    def open_session(self, session):
+        with self.condition:
+            self.num_sessions += 1
+
+    def close_session(self, session):
+        with self.condition:
+            self.num_sessions -= 1
+            self.condition.notify()
+
+    def evaluate(self, session, x, sr):
+        if sr != self.sampling_rate:
+            raise ValueError(f"BatchedVAD is for sampling rate {self.sampling_rate}, not {sr}.")
+        # copied, because FixedVADIterator reuses its window
+        request = _Request(session, np.array(x, dtype=np.float32).reshape(-1))
+        with self.condition:
+            self.pending.append(request)
+            self.condition.notify()
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.prob
+
+    def next_batch(self):
+        with self.condition:
+            while not self.pending:
+                self.condition.wait()
+            deadline = time.monotonic() + self.max_wait
+            while len(self.pending) < min(self.num_sessions, self.max_batch):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            batch = self.pending[:self.max_batch]
+            del self.pending[:self.max_batch]
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            try:
+                x = np.stack([r.window for r in batch])
+                probs, states = self.model.batch_step(x, [r.session.state for r in batch], self.sampling_rate)
+                for r, p, s in zip(batch, probs, states):
+                    r.session.state = s
+                    r.prob = np.float32(p)
+            except Exception as e:
+                logger.exception("Batched VAD failed")
+                for r in batch:
+                    r.error = e
+            self.batches += 1
+            self.windows += len(batch)
+            for r in batch:
+                r.done.set()
+
+
+@lru_cache(maxsize=None)
+def shared_vad_service(backend="silero", model_path=None):
+    '''One BatchedVAD for every backend and model in the process, shared by all sessions.'''
+    return BatchedVAD(load_vad_model(backend, model_path))
@@ -0,0 +1,153 @@
+# The same file is in diart_node/, merger_node/ and simulstreaming_node/whisper_streaming/, because the nodes run as
+# separate scripts and share no package. diart_node/live_profiler.py is the source, keep the copies identical to it.
+import os
+import sys
+import time
+import signal
+import logging
+import threading
+from collections import Counter
+from typing import Optional
+
+
+logger = logging.getLogger(__name__)
+
+# Seconds between two samples of the Python stacks
+PROFILE_INTERVAL = 0.01
+
+
+def _stack(frame) -> str:
+    """
+    Format a Python stack as one line of the folded flame graph format, from the outermost frame.
+
+    Args:
+        frame: The innermost frame of the stack.
+
+    Returns:
+        str: The frames separated by semicolons.
+    """
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class LiveProfiler:
+    """
+    Captures a time-boxed profile of the running process on a signal, e.g. `kill -USR1 <pid>`,
+    without interrupting it.
+
+    A capture writes two files to the output directory:
+      - <name>.stacks.txt: Python stacks of all threads, sampled every PROFILE_INTERVAL seconds,
+        in the folded flame graph format ("thread;frame;frame;... count" per line).
+      - <name>.torch.json: torch.profiler trace of the torch operators, for chrome://tracing or
+        Perfetto. Only if torch is imported by the process. The capture runs in its own thread, so the
+        CPU operators of the other threads are recorded only with profile_all_threads of the torch
+        profiler (torch 2.4+). With older versions, the trace has only the CUDA activity.
+
+    Only one capture runs at a time; a signal during a capture is ignored.
+
+    Attributes:
+        output_dir (str): Directory of the captured profiles.
+        seconds (float): Length of a capture in seconds.
+    """
+
+    def __init__(self, output_dir: str, seconds: float = 20) -> None:
+        """
+        Initialize the LiveProfiler.
+
+        Args:
+            output_dir (str): Directory of the captured profiles.
+            seconds (float): Length of a capture in seconds.
+        """
+        self.output_dir = output_dir
+        self.seconds = seconds
+        self._running = threading.Lock()
+
+    def install(self, signum: Optional[int] = getattr(signal, "SIGUSR1", None)) -> None:
+        """
+        Start a capture whenever the process receives the signal. Must be called from the main thread.
+
+        Args:
+            signum (Optional[int]): The signal, SIGUSR1 by default. None if the platform has no SIGUSR1.
+        """
+        if signum is None:
+            logger.warning("Live profiling is not available, there is no SIGUSR1 on this platform.")
+            return
+        signal.signal(signum, lambda *_: self.start())
+        logger.info(f"Live profiling: kill -{signal.Signals(signum).name[3:]} {os.getpid()} captures {self.seconds} s "
+                    f"to {self.output_dir}")
+
+    def start(self) -> None:
+        """
+        Start a capture in a background thread, unless one is already running.
+        """
+        if not self._running.acquire(blocking=False):
+            logger.warning("A profile is already being captured.")
+            return
+        threading.Thread(target=self._capture, daemon=True, name="live profiler").start()
+
+    def _capture(self) -> None:
+        """
+        Capture the profile and write its files.
+        """
+        try:
+            os.makedirs(self.output_dir, exist_ok=True)
+            name = os.path.join(self.output_dir, time.strftime("profile-%Y%m%d-%H%M%S") + f"-{os.getpid()}")
+            torch_profiler = self._start_torch_profiler()
+            stacks = self._sample()
+            if torch_profiler is not None:
+                torch_profiler.stop()
+                torch_profiler.export_chrome_trace(name + ".torch.json")
+            with open(name + ".stacks.txt", "w") as f:
+                for stack, count in stacks.most_common():
+                    print(stack, count, file=f)
+            print(f"Profile written to {name}.*", file=sys.stderr)
+        except Exception:
+            logger.exception("Capturing a profile failed")
+        finally:
+            self._running.release()
+
+    def _start_torch_profiler(self):
+        """
+        Start torch.profiler if torch is used by the process.
+
+        Returns:
+            The running torch.profiler.profile, or None without torch.
+        """
+        if "torch" not in sys.modules:
+            return None
+        import torch
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        try:
+            # Record the operators of all threads, not only of this one
+            config = torch._C._profiler._ExperimentalConfig(profile_all_threads=True)
+        except (AttributeError, TypeError):
+            config = None
+            logger.warning("This torch version can't profile the operators of other threads, only the CUDA activity "
+                           "is captured in the torch trace.")
+        profiler = torch.profiler.profile(activities=activities, record_shapes=True, experimental_config=config)
+        profiler.start()
+        return profiler
+
+    def _sample(self) -> Counter:
+        """
+        Sample the Python stacks of all other threads for the length of the capture.
+
+        Returns:
+            Counter: Number of samples of every stack.
+        """
+        me = threading.get_ident()
+        stacks = Counter()
+        end = time.monotonic() + self.seconds
+        while time.monotonic() < end:
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident != me:
+                    stacks[names.get(ident, str(ident)) + ";" + _stack(frame)] += 1
+            time.sleep(PROFILE_INTERVAL)
+        return stacks
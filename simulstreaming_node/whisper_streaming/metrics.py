@@ -0,0 +1,177 @@
+import time
+import bisect
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+# Metrics of the node in the Prometheus text format, served on a local HTTP endpoint with --metrics-port.
+#
+# The metrics are process-wide and shared by all sessions. An update is a dict operation and a bisect under one lock,
+# a timer is two perf_counter() calls, so they are always on. The timers measure the wall time of the Python code: on
+# GPU, a stage that only launches kernels is counted in the next stage that waits for them, e.g. in .item().
+#
+# The rates are computed by Prometheus from the counters, e.g. the tokens per second:
+#   rate(simulstreaming_tokens_total[1m])
+# and the real-time factor:
+#   rate(simulstreaming_processing_seconds_total[1m]) / rate(simulstreaming_audio_seconds_total[1m])
+
+# seconds
+TIME_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+LAG_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 4.0, 8.0, 16.0, 32.0)
+RTF_BUCKETS = (0.05, 0.1, 0.2, 0.3, 0.5, 0.75, 1.0, 1.5, 2.0, 4.0)
+
+_lock = threading.Lock()
+_metrics = []
+
+
+def _labels_text(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+
+class Counter:
+    '''A monotonic counter, optionally with labels, e.g. counter.inc(reason="rewind").'''
+
+    kind = "counter"
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.values = {}  # sorted label items -> value
+        _metrics.append(self)
+
+    def inc(self, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with _lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def samples(self):
+        for key, value in self.values.items():
+            yield self.name, key, value
+
+
+class Gauge(Counter):
+    '''A value that can go up and down.'''
+
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with _lock:
+            self.values[key] = value
+
+
+class _Timer:
+    __slots__ = ("histogram", "labels", "start")
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+
+class Histogram:
+    '''Cumulative histogram with fixed buckets, optionally with labels. time() measures a with block.'''
+
+    kind = "histogram"
+
+    def __init__(self, name, help, buckets=TIME_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.values = {}  # sorted label items -> [count per bucket and +Inf, sum]
+        _metrics.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        i = bisect.bisect_left(self.buckets, value)
+        with _lock:
+            v = self.values.get(key)
+            if v is None:
+                v = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            v[0][i] += 1
+            v[1] += value
+
+    def time(self, **labels):
+        return _Timer(self, labels)
+
+    def samples(self):
+        for key, (counts, total) in self.values.items():
+            cumulative = 0
+            for le, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                yield self.name + "_bucket", key + (("le", le),), cumulative
+            yield self.name + "_sum", key, total
+            yield self.name + "_count", key, cumulative
+
+
+def render():
+    '''All metrics in the Prometheus text exposition format.'''
+    lines = []
+    with _lock:
+        for metric in _metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{_labels_text(labels)} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def reset():
+    '''Clears the values of all metrics, e.g. after the warm-up.'''
+    with _lock:
+        for metric in _metrics:
+            metric.values.clear()
+
+
+######### Metrics of the node
+
+# the stages of an update: "mel", "encoder", "decoder_step", "alignment", "tokenizer", "output"
+stage_seconds = Histogram("simulstreaming_stage_seconds", "Time of one run of a stage of the processing.")
+update_seconds = Histogram("simulstreaming_update_seconds", "Time of one update, process_iter() of the online processor.")
+update_rtf = Histogram("simulstreaming_update_rtf", "Real-time factor of one update: its time divided by the new audio.",
+                       RTF_BUCKETS)
+audio_lag_seconds = Histogram("simulstreaming_audio_lag_seconds",
+                              "Time from receiving the oldest unprocessed audio to the update that processes it.", LAG_BUCKETS)
+queued_audio_seconds = Gauge("simulstreaming_queued_audio_seconds", "Audio received and not processed at the last update.")
+processing_seconds = Counter("simulstreaming_processing_seconds_total", "Time of all updates.")
+audio_seconds = Counter("simulstreaming_audio_seconds_total", "Audio received from the clients and processed.")
+tokens = Counter("simulstreaming_tokens_total", "Tokens committed to the output.")
+decoding_stops = Counter("simulstreaming_decoding_stops_total",
+                         "Decoding loops that stopped early, by reason: no_speech, rewind, budget, repetition.")
+sessions = Gauge("simulstreaming_active_sessions", "Client connections that are served.")
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+def serve_metrics(host, port):
+    '''Serves the metrics on http://host:port/metrics in a daemon thread.'''
+    server = ThreadingHTTPServer((host, port), _Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True, name="metrics").start()
+    logger.info(f"Metrics on http://{host}:{port}/metrics")
+    return server
@@ -0,0 +1,145 @@
+import socket
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Audio input of the server: raw 16-bit little-endian mono PCM from a socket. The bytes are received into a
+# preallocated buffer and decoded with one vectorized operation straight into a preallocated float32 ring buffer,
+# without any per-packet decoder objects or concatenation. A packet may end in the middle of a sample, the odd byte is
+# carried over to the next packet.
+#
+# The int16 samples are scaled by 1/32768, exactly as soundfile decodes PCM_16.
+
+PCM_DTYPE = np.dtype("<i2")
+PCM_SCALE = np.float32(1 / 32768)
+
+
+class AudioRingBuffer:
+    '''Preallocated float32 FIFO of audio samples. write() appends, read() returns all buffered samples as a new
+    array, because the online processors keep references to the inserted chunks.'''
+
+    def __init__(self, capacity):
+        self.buffer = np.zeros(capacity, dtype=np.float32)
+        self.beg = 0  # position of the first buffered sample
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def capacity(self):
+        return len(self.buffer)
+
+    @property
+    def free(self):
+        return self.capacity - self.size
+
+    def free_slices(self, n):
+        '''One or two views into the ring for the next n samples, which must fit. Fill them, then commit(n).'''
+        if n > self.free:
+            raise ValueError(f"{n} samples don't fit to the audio buffer with {self.free} free samples.")
+        end = (self.beg + self.size) % self.capacity
+        first = min(n, self.capacity - end)
+        return self.buffer[end:end + first], self.buffer[:n - first]
+
+    def commit(self, n):
+        self.size += n
+
+    def write(self, samples):
+        head, tail = self.free_slices(len(samples))
+        head[:] = samples[:len(head)]
+        tail[:] = samples[len(head):]
+        self.commit(len(samples))
+
+    def read(self):
+        end = self.beg + self.size
+        if end <= self.capacity:
+            out = self.buffer[self.beg:end].copy()
+        else:
+            out = np.concatenate((self.buffer[self.beg:], self.buffer[:end - self.capacity]))
+        self.beg = 0
+        self.size = 0
+        return out
+
+
+class PCMReceiver:
+    '''Receives the PCM of one connection into an AudioRingBuffer. If the client sends another sampling rate than the
+    one of the ASR, the audio is resampled by a streaming soxr resampler, otherwise it is only decoded.'''
+
+    def __init__(self, conn, sampling_rate=16000, input_sampling_rate=16000, capacity_seconds=30, packet_size=65536):
+        self.conn = conn
+        self.ring = AudioRingBuffer(int(capacity_seconds * sampling_rate))
+        self.packet = bytearray(packet_size + 1)  # +1 for the carried-over byte
+        self.carry = 0
+        self.closed = False
+
+        if input_sampling_rate == sampling_rate:
+            self.resampler = None
+        else:
+            import soxr
+            logger.info(f"Resampling the input audio from {input_sampling_rate} to {sampling_rate} Hz.")
+            self.resampler = soxr.ResampleStream(input_sampling_rate, sampling_rate, 1, dtype="float32")
+            self.decoded = np.zeros(packet_size // 2, dtype=np.float32)
+
+    def receive(self, block=True):
+        '''Receives the available bytes into the ring, at most one packet. If block, waits until some bytes arrive.
+        Returns False if nothing was received: the connection is closed, the ring is full, or nothing is available.'''
+        if self.closed:
+            return False
+        max_bytes = len(self.packet) - 1
+        if self.resampler is None:
+            # the decoded samples must fit to the ring
+            max_bytes = min(max_bytes, 2 * self.ring.free)
+        if max_bytes <= 0:
+            return False
+        view = memoryview(self.packet)
+        try:
+            n = self.conn.recv_into(view[self.carry:self.carry + max_bytes], 0, 0 if block else socket.MSG_DONTWAIT)
+        except BlockingIOError:
+            return False
+        except ConnectionResetError:
+            n = 0
+        if n == 0:
+            self.close()
+            return False
+        n += self.carry
+        num_samples = n // 2
+        self.decode(np.frombuffer(self.packet, dtype=PCM_DTYPE, count=num_samples))
+        self.carry = n % 2
+        if self.carry:
+            self.packet[0] = self.packet[n - 1]
+        return True
+
+    def decode(self, pcm):
+        if self.resampler is None:
+            head, tail = self.ring.free_slices(len(pcm))
+            np.multiply(pcm[:len(head)], PCM_SCALE, out=head)
+            np.multiply(pcm[len(head):], PCM_SCALE, out=tail)
+            self.ring.commit(len(pcm))
+        else:
+            decoded = self.decoded[:len(pcm)]
+            np.multiply(pcm, PCM_SCALE, out=decoded)
+            self.write_resampled(self.resampler.resample_chunk(decoded))
+
+    def write_resampled(self, samples):
+        if len(samples) > self.ring.free:
+            logger.warning(f"The audio buffer is full, {len(samples) - self.ring.free} samples are dropped.")
+            samples = samples[:self.ring.free]
+        self.ring.write(samples)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.carry:
+            logger.debug("The connection was closed in the middle of a sample, the last byte is dropped.")
+        if self.resampler is not None:
+            self.write_resampled(self.resampler.resample_chunk(np.zeros(0, dtype=np.float32), last=True))
+
+    def __len__(self):
+        return len(self.ring)
+
+    def read(self):
+        return self.ring.read()
@@ -74,9 +74,14 @@ class VADIterator:
                 raise TypeError("Audio cannot be casted to tensor. Cast it manually")
 
         window_size_samples = len(x[0]) if x.dim() == 2 else len(x)
-        self.current_sample += window_size_samples
-
         speech_prob = self.model(x, self.sampling_rate).item()
+        return self.update(speech_prob, window_size_samples, return_seconds, time_resolution)
+
+    def update(self, speech_prob: float, window_size_samples: int, return_seconds=False, time_resolution: int = 1):
+        """
+        The state machine of __call__, with the speech probability of the next window that was already computed.
+        """
+        self.current_sample += window_size_samples
 
         if (speech_prob >= self.threshold) and self.temp_end:
             self.temp_end = 0
@@ -107,18 +112,42 @@ class FixedVADIterator(VADIterator):
     '''It fixes VADIterator by allowing to process any audio length, not only exactly 512 frames at once.
     If audio to be processed at once is long and multiple voiced segments detected, 
     then __call__ returns the start of the first segment, and end (or middle, which means no end) of the last segment. 
+
+    The audio is copied once, to a window tensor that is reused for all the windows, so the model must not keep
+    a reference to its input. The speech probabilities of a model on GPU are copied to the host once for all the
+    windows of one call.
     '''
 
+    WINDOW = 512
+
     def reset_states(self):
         super().reset_states()
-        self.buffer = np.array([],dtype=np.float32)
+        self.window = torch.zeros(self.WINDOW)
+        self.buffer = self.window.numpy()  # the same memory
+        self.buffer_len = 0  # samples of the next window received so far
 
+    @torch.no_grad()
     def __call__(self, x, return_seconds=False):
-        self.buffer = np.append(self.buffer, x) 
+        x = np.asarray(x, dtype=np.float32)
+        probs = []
+        pos = 0
+        while pos < len(x):
+            n = min(self.WINDOW - self.buffer_len, len(x) - pos)
+            self.buffer[self.buffer_len:self.buffer_len + n] = x[pos:pos + n]
+            self.buffer_len += n
+            pos += n
+            if self.buffer_len == self.WINDOW:
+                probs.append(self.model(self.window, self.sampling_rate))
+                self.buffer_len = 0
+        if len(probs) > 1 and torch.is_tensor(probs[0]) and probs[0].device.type != "cpu":
+            # one device synchronization for all the windows. On CPU, .item() has no synchronization and it's cheaper.
+            probs = torch.cat([p.reshape(-1) for p in probs]).tolist()
+        else:
+            probs = [p.item() for p in probs]
+
         ret = None
-        while len(self.buffer) >= 512:
-            r = super().__call__(self.buffer[:512], return_seconds=return_seconds)
-            self.buffer = self.buffer[512:]
+        for speech_prob in probs:
+            r = self.update(speech_prob, self.WINDOW, return_seconds=return_seconds)
             if ret is None:
                 ret = r
             elif r is not None:
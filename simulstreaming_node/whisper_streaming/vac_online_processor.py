@@ -1,5 +1,7 @@
 from whisper_streaming.base import OnlineProcessorInterface
 from whisper_streaming.silero_vad_iterator import FixedVADIterator
+from whisper_streaming.vad_backends import load_vad_model
+from whisper_streaming.batched_vad import shared_vad_service
 import numpy as np
 
 import logging
@@ -14,17 +16,19 @@ class VACOnlineASRProcessor(OnlineProcessorInterface):
     When it detects end of speech (non-voice for 500ms), it makes OnlineASRProcessor to end the utterance immediately.
     '''
 
-    def __init__(self, online_chunk_size, online):
+    vad_session = None  # the session of BatchedVAD, with batched_vad
+
+    def __init__(self, online_chunk_size, online, vad_backend="silero", vad_model_path=None, batched_vad=False):
         self.online_chunk_size = online_chunk_size
 
         self.online = online
 
         # VAC:
-        import torch
-        model, _ = torch.hub.load(
-            repo_or_dir='snakers4/silero-vad',
-            model='silero_vad'
-        )
+        if batched_vad:
+            # the model is shared with the other sessions in this process, see BatchedVAD
+            model = self.vad_session = shared_vad_service(vad_backend, vad_model_path).session()
+        else:
+            model = load_vad_model(vad_backend, vad_model_path)
         self.vac = FixedVADIterator(model)  # we use the default options there: 500ms silence, 100ms padding, etc.  
 
         self.init()
@@ -32,34 +36,68 @@ class VACOnlineASRProcessor(OnlineProcessorInterface):
     def init(self):
         self.online.init()
         self.vac.reset_states()
+        if self.vad_session is not None:
+            self.vad_session.open()
         self.current_online_chunk_buffer_size = 0
 
         self.is_currently_final = False
 
         self.status = None  # or "voice" or "nonvoice"
-        self.audio_buffer = np.array([],dtype=np.float32)
+        # audio_buffer is self.buffer[self.buffer_beg:self.buffer_end], preallocated for a few seconds. It's compacted
+        # to the beginning only when the next chunk doesn't fit at the end.
+        self.buffer = np.zeros(4*self.SAMPLING_RATE, dtype=np.float32)
+        self.buffer_beg = 0
+        self.buffer_end = 0
         self.buffer_offset = 0  # in frames
 
+    @property
+    def audio_buffer(self):
+        # a view, it's copied before it is sent to the online processor, because the buffer is reused
+        return self.buffer[self.buffer_beg:self.buffer_end]
+
+    def append_to_buffer(self, audio):
+        n = len(audio)
+        length = self.buffer_end - self.buffer_beg
+        if self.buffer_end + n > len(self.buffer):
+            if length + n > len(self.buffer):
+                buffer = np.zeros(2*(length + n), dtype=np.float32)
+                buffer[:length] = self.audio_buffer
+                self.buffer = buffer
+            else:
+                self.buffer[:length] = self.audio_buffer
+            self.buffer_beg, self.buffer_end = 0, length
+        self.buffer[self.buffer_end:self.buffer_end + n] = audio
+        self.buffer_end += n
+
     def clear_buffer(self):
         #self.buffer_offset += len(self.audio_buffer)
-        self.audio_buffer = np.array([],dtype=np.float32)
+        self.buffer_beg = self.buffer_end = 0
 
 
     def insert_audio_chunk(self, audio):
-        res = self.vac(audio)
-        self.audio_buffer = np.append(self.audio_buffer, audio)
+        self.insert_vad_result(audio, self.vac(audio))
+
+    def insert_vad_result(self, audio, res):
+        '''insert_audio_chunk with the result of self.vac on the audio. The VAD can run in another thread, e.g. in the
+        reader of the server connection, but on the chunks in the same order.'''
+        if res is None and self.status == 'voice':
+            # the buffer is always empty during voice, so the chunk is sent directly, without copying
+            self.online.insert_audio_chunk(audio)
+            self.current_online_chunk_buffer_size += len(audio)
+            return
+        self.append_to_buffer(audio)
         if res is not None:
             frame = list(res.values())[0]
             if 'start' in res and 'end' not in res:
                 self.status = 'voice'
-                send_audio = self.audio_buffer[frame:]
+                send_audio = self.audio_buffer[frame:].copy()
                 self.online.init(offset=frame/self.SAMPLING_RATE)
                 self.online.insert_audio_chunk(send_audio)
                 self.current_online_chunk_buffer_size += len(send_audio)
                 self.clear_buffer()
             elif 'end' in res and 'start' not in res:
                 self.status = 'nonvoice'
-                send_audio = self.audio_buffer[:frame]
+                send_audio = self.audio_buffer[:frame].copy()
                 self.online.insert_audio_chunk(send_audio)
                 self.current_online_chunk_buffer_size += len(send_audio)
                 self.is_currently_final = True
@@ -68,7 +106,7 @@ class VACOnlineASRProcessor(OnlineProcessorInterface):
                 beg = res["start"]-self.buffer_offset
                 end = res["end"]-self.buffer_offset
                 self.status = 'nonvoice'
-                send_audio = self.audio_buffer[beg:end]
+                send_audio = self.audio_buffer[beg:end].copy()
                 self.online.init(offset=(res["start"]/self.SAMPLING_RATE))
                 self.online.insert_audio_chunk(send_audio)
                 self.current_online_chunk_buffer_size += len(send_audio)
@@ -76,15 +114,10 @@ class VACOnlineASRProcessor(OnlineProcessorInterface):
                 #self.buffer_offset += len(self.audio_buffer)-res["start"] + len(self.audio_buffer)-res["end"]
                 self.clear_buffer()
         else:
-            if self.status == 'voice':
-                self.online.insert_audio_chunk(self.audio_buffer)
-                self.current_online_chunk_buffer_size += len(self.audio_buffer)
-                self.clear_buffer()
-            else:
-                # We keep 1 second because VAD may later find start of voice in it.
-                # But we trim it to prevent OOM. 
-                self.buffer_offset += max(0,len(self.audio_buffer)-self.SAMPLING_RATE)
-                self.audio_buffer = self.audio_buffer[-self.SAMPLING_RATE:]
+            # We keep 1 second because VAD may later find start of voice in it.
+            # But we trim it to prevent OOM. 
+            self.buffer_offset += max(0,len(self.audio_buffer)-self.SAMPLING_RATE)
+            self.buffer_beg = max(self.buffer_beg, self.buffer_end-self.SAMPLING_RATE)
 
 
     def process_iter(self):
@@ -102,4 +135,81 @@ class VACOnlineASRProcessor(OnlineProcessorInterface):
         ret = self.online.finish()
         self.current_online_chunk_buffer_size = 0
         self.is_currently_final = False
-        return ret
\ No newline at end of file
+        return ret
+
+    def close(self):
+        if self.vad_session is not None:
+            # the batches of the other sessions don't wait for this idle one
+            self.vad_session.close()
+
+class IndexedVACOnlineASRProcessor(VACOnlineASRProcessor):
+    '''VACOnlineASRProcessor with the voice segments from a VAD index (see vad_indexer.py), instead of running the VAD.
+    The audio outside the segments is dropped, so it's never decoded.
+
+    segments: list of (beg, end) in samples, from the beginning of the audio
+    start: the position of the first received sample, e.g. with --start_at
+    '''
+
+    def __init__(self, online_chunk_size, online, segments, start=0):
+        self.online_chunk_size = online_chunk_size
+        self.online = online
+        self.segments = segments
+        self.start = start
+        self.init()
+
+    def init(self):
+        self.online.init()
+        self.current_online_chunk_buffer_size = 0
+        self.is_currently_final = False
+        self.status = None
+
+        self.position = self.start  # of the next sample
+        self.segment = 0  # index of the current or the next segment
+        while self.segment < len(self.segments) and self.segments[self.segment][1] <= self.start:
+            self.segment += 1
+        self.pending = None  # the audio after the end of a segment, it's processed with the next chunk
+
+    def insert_audio_chunk(self, audio):
+        if self.pending is not None:
+            audio = np.concatenate([self.pending, audio])
+            self.pending = None
+        beg = self.position
+        end = beg + len(audio)
+        if self.segment < len(self.segments):
+            seg_beg, seg_end = self.segments[self.segment]
+            seg_beg = max(seg_beg, beg)
+            if seg_beg < end:
+                if self.status != 'voice':
+                    self.status = 'voice'
+                    self.online.init(offset=seg_beg/self.SAMPLING_RATE)
+                send_audio = audio[seg_beg-beg:min(seg_end, end)-beg]
+                self.online.insert_audio_chunk(send_audio)
+                self.current_online_chunk_buffer_size += len(send_audio)
+                if seg_end <= end:
+                    # one segment ends in one call, the next one can start in the rest of the audio
+                    self.status = 'nonvoice'
+                    self.is_currently_final = True
+                    self.segment += 1
+                    self.pending = audio[seg_end-beg:]
+                    end = seg_end
+        self.position = end
+
+    def process_iter(self):
+        if self.is_currently_final:
+            # the end of a segment, not of the stream like finish()
+            return super().finish()
+        return super().process_iter()
+
+    def finish(self):
+        ret = super().finish()
+        # the segments in the rest of the last chunk, their outputs are merged
+        while self.pending is not None and len(self.pending) > 0:
+            segment = self.segment
+            self.insert_audio_chunk(self.pending[:0])
+            if self.status == 'voice' or self.segment != segment:
+                o = super().finish()
+                if ret[0] is None:
+                    ret = o
+                elif o[0] is not None:
+                    ret = (ret[0], o[1], ret[2] + o[2])
+        return ret
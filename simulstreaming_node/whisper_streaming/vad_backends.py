@@ -0,0 +1,174 @@
+import os
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# VAD models for VADIterator and FixedVADIterator.
+# A model is called with a window of audio (512 samples at 16kHz, as torch.Tensor or np.ndarray) and the sampling
+# rate, and it returns the speech probability of the window as an object with .item(). reset_states() resets its
+# recurrent state before a new stream.
+#
+# New backends are added with the register_vad_backend decorator. Every backend is a function of model_path,
+# which may be None.
+
+VAD_BACKENDS = {}
+
+
+def register_vad_backend(name):
+    def register(load):
+        VAD_BACKENDS[name] = load
+        return load
+    return register
+
+
+def load_vad_model(backend="silero", model_path=None):
+    if backend not in VAD_BACKENDS:
+        raise ValueError(f"Unknown VAD backend {backend}. Use one of {list(VAD_BACKENDS)}.")
+    if model_path is not None and not os.path.isfile(model_path):
+        raise FileNotFoundError(f"The VAD model {model_path} does not exist.")
+    logger.info(f"Loading VAD backend {backend}" + (f" from {model_path}" if model_path else ""))
+    return VAD_BACKENDS[backend](model_path)
+
+
+@register_vad_backend("silero")
+def load_silero(model_path=None):
+    '''Silero VAD TorchScript model. From model_path (e.g. silero_vad.jit from the silero-vad repo or pip package),
+    or from torch.hub, which requires network access or a warm hub cache.'''
+    import torch
+    if model_path is None:
+        model, _ = torch.hub.load(
+            repo_or_dir='snakers4/silero-vad',
+            model='silero_vad'
+        )
+        return model
+    model = torch.jit.load(model_path, map_location="cpu")
+    model.eval()
+    return model
+
+
+class SileroJitBatch:
+    '''batch_step of the Silero v5 TorchScript model. The model keeps the state of one batch in its attributes, so the
+    states of the streams are stacked to them before the forward pass and split after it.'''
+
+    ATTRIBUTES = ("_state", "_context", "_last_sr", "_last_batch_size")
+
+    def __init__(self, model):
+        if not all(hasattr(model, a) for a in self.ATTRIBUTES):
+            raise ValueError("This Silero TorchScript model does not expose its state, it can't be batched. "
+                             "Use Silero v5, or the silero-onnx backend.")
+        self.model = model
+
+    def batch_step(self, x, states, sr: int):
+        import torch
+        context_size = 64 if sr == 16000 else 32
+        state = torch.zeros(2, len(x), 128)
+        context = torch.zeros(len(x), context_size)
+        for i, s in enumerate(states):
+            if s is not None:
+                state[:, i], context[i] = s
+        m = self.model
+        m._state, m._context, m._last_sr, m._last_batch_size = state, context, sr, len(x)
+        with torch.no_grad():
+            out = m(torch.from_numpy(x), sr)
+        return out[:, 0].numpy(), [(m._state[:, i], m._context[i]) for i in range(len(x))]
+
+
+def batched(model):
+    '''The model with batch_step(x, states, sr), which evaluates one window of every stream, each with its own
+    state. See BatchedVAD.'''
+    if hasattr(model, "batch_step"):
+        return model
+    return SileroJitBatch(model)
+
+
+class SileroOnnx:
+    '''Silero VAD v5 ONNX model (silero_vad.onnx) in onnxruntime, with the same interface as the TorchScript model.
+    This is a trimmed copy of OnnxWrapper from silero-vad's utils_vad.py (MIT licence).'''
+
+    def __init__(self, model_path):
+        try:
+            import onnxruntime
+        except ImportError as e:
+            raise ImportError("The silero-onnx VAD backend requires onnxruntime: pip install onnxruntime") from e
+        opts = onnxruntime.SessionOptions()
+        # one stream is small, the threads would only compete with Whisper
+        opts.inter_op_num_threads = 1
+        opts.intra_op_num_threads = 1
+        self.session = onnxruntime.InferenceSession(model_path, providers=['CPUExecutionProvider'], sess_options=opts)
+        self.reset_states()
+
+    def reset_states(self):
+        self.state = None
+
+    def __call__(self, x, sr: int):
+        x = np.asarray(x, dtype=np.float32).reshape(1, -1)
+        probs, (self.state,) = self.batch_step(x, [self.state], sr)
+        return probs[0]
+
+    def batch_step(self, x, states, sr: int):
+        '''x: (B, 512) windows of B streams. states: per stream the recurrent state and the context (the end of the
+        previous window), None for a new stream. Returns the speech probabilities (B,) and the new states.'''
+        context_size = 64 if sr == 16000 else 32
+        state = np.zeros((2, len(x), 128), dtype=np.float32)
+        context = np.zeros((len(x), context_size), dtype=np.float32)
+        for i, s in enumerate(states):
+            if s is not None:
+                state[:, i], context[i] = s
+        x = np.concatenate([context, x], axis=1)
+        out, state = self.session.run(None, {'input': x, 'state': state, 'sr': np.array(sr, dtype=np.int64)})
+        return out[:, 0], [(state[:, i], x[i, -context_size:]) for i in range(len(x))]
+
+
+@register_vad_backend("silero-onnx")
+def load_silero_onnx(model_path=None):
+    if model_path is None:
+        raise ValueError("The silero-onnx VAD backend requires the path to silero_vad.onnx.")
+    return SileroOnnx(model_path)
+
+
+class EnergyVAD:
+    '''Pure NumPy VAD from the energy and the zero-crossing rate of the window. It costs a fraction of Silero, but it is
+    much less robust to noise, music and non-stationary background.
+
+    The speech probability is a sigmoid of the window energy above the noise floor, centered at snr_db. The noise floor
+    follows the energy down immediately and up slowly, by floor_rise_db per second, so that a constant background is
+    learned in some seconds. It starts at the energy of the first window. Windows quieter than min_energy_db are
+    silence. Windows with zero-crossing rate above max_zcr (noise, or unvoiced sounds) have the probability halved, so
+    they can continue a speech segment but not start it.
+    '''
+
+    def __init__(self, snr_db=10.0, slope_db=2.0, min_energy_db=-55.0, max_zcr=0.3, floor_rise_db=1.0):
+        self.snr_db = snr_db
+        self.slope_db = slope_db
+        self.min_energy_db = min_energy_db
+        self.max_zcr = max_zcr
+        self.floor_rise_db = floor_rise_db
+        self.reset_states()
+
+    def reset_states(self):
+        self.noise_db = None
+
+    def __call__(self, x, sr: int):
+        x = np.asarray(x, dtype=np.float32).reshape(1, -1)
+        probs, (self.noise_db,) = self.batch_step(x, [self.noise_db], sr)
+        return probs[0]
+
+    def batch_step(self, x, states, sr: int):
+        '''x: (B, N) windows of B streams. states: their noise floors in dB, None for a new stream.
+        Returns the speech probabilities (B,) and the new states.'''
+        energy_db = 10 * np.log10(np.einsum('ij,ij->i', x, x) / x.shape[1] + 1e-12)
+        zcr = np.count_nonzero(np.signbit(x[:, 1:]) != np.signbit(x[:, :-1]), axis=1) / (x.shape[1] - 1)
+        noise_db = np.array([e if s is None else s for s, e in zip(states, energy_db)])
+        noise_db = np.minimum(energy_db, noise_db + self.floor_rise_db * x.shape[1] / sr)
+
+        probs = 1 / (1 + np.exp((self.snr_db - (energy_db - noise_db)) / self.slope_db))
+        probs[zcr > self.max_zcr] /= 2
+        probs[energy_db < self.min_energy_db] = 0
+        return probs.astype(np.float32), list(noise_db)
+
+
+@register_vad_backend("energy")
+def load_energy(model_path=None):
+    return EnergyVAD()
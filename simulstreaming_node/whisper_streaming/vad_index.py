@@ -0,0 +1,63 @@
+import os
+
+# VAD index of an audio file: the speech segments found by FixedVADIterator, computed once by vad_indexer.py, so that
+# the simulation from file and the benchmarks can skip the non-speech audio without running the VAD again.
+#
+# It's a text file, <audio path>.vad by default. The first line is a header, then one "beg<TAB>end" line for every
+# segment, in samples:
+#   # vad index: backend=silero sampling_rate=16000 num_samples=928000
+#   25600	57600
+
+SUFFIX = ".vad"
+HEADER = "# vad index:"
+
+
+def default_index_path(audio_path, out_dir=None):
+    if out_dir is None:
+        return audio_path + SUFFIX
+    return os.path.join(out_dir, os.path.basename(audio_path) + SUFFIX)
+
+
+def find_speech_segments(audio, vad):
+    '''Returns the list of (beg, end) speech segments of the audio in samples. vad: FixedVADIterator, it's reset.
+    The audio is processed one window at a time, so every call returns at most one event.'''
+    vad.reset_states()
+    segments = []
+    start = None
+    window = vad.WINDOW
+    for i in range(0, len(audio) - window + 1, window):
+        r = vad(audio[i:i + window])
+        if r is None:
+            continue
+        if 'start' in r:
+            start = r['start']
+        if 'end' in r:
+            segments.append((start, min(r['end'], len(audio))))
+            start = None
+    if start is not None:
+        segments.append((start, len(audio)))
+    return segments
+
+
+def write_vad_index(path, segments, num_samples, backend, sampling_rate=16000):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        f.write(f"{HEADER} backend={backend} sampling_rate={sampling_rate} num_samples={num_samples}\n")
+        for beg, end in segments:
+            f.write(f"{beg}\t{end}\n")
+    # an interrupted run never leaves a partial index
+    os.replace(tmp_path, path)
+
+
+def read_vad_index(path, num_samples=None):
+    '''Returns the list of (beg, end) segments in samples. If num_samples is set, it's checked that the index was
+    made for the audio of that length.'''
+    with open(path) as f:
+        header = f.readline()
+        if not header.startswith(HEADER):
+            raise ValueError(f"{path} is not a VAD index.")
+        info = dict(item.split("=", 1) for item in header[len(HEADER):].split())
+        if num_samples is not None and int(info["num_samples"]) != num_samples:
+            raise ValueError(f"The VAD index {path} is for audio of {info['num_samples']} samples, not {num_samples}. "
+                             "Make the index again.")
+        return [tuple(map(int, line.split())) for line in f if line.strip()]
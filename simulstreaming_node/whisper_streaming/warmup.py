@@ -0,0 +1,61 @@
+import time
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Warm-up of an online processor with synthetic audio, so that no wav file is needed, and the first request of a
+# client is not slower than the next ones. The first decoding of every audio length grows the allocator caches and
+# the KV cache of its number of tokens, and it runs the language identification, the compiled graphs (with --compile)
+# and the finishing of a segment.
+#
+# The audio is a voiced, speech-like signal: harmonics of a gliding pitch, modulated at a syllable rate, with some
+# noise. Pure silence would be skipped by the decoding, see --silence_rms. It is deterministic, every warm-up is the
+# same.
+
+SAMPLING_RATE = 16000
+
+# seconds of the audio of the warm-up decodings, up to the default --audio_max_len
+WARMUP_LENGTHS = [1, 5, 15, 30]
+
+
+def synthetic_audio(seconds, sampling_rate=SAMPLING_RATE, seed=0):
+    '''Speech-like float32 audio of the given length, in [-1, 1].'''
+    n = int(seconds * sampling_rate)
+    t = np.arange(n) / sampling_rate
+    pitch = 140 + 40 * np.sin(2 * np.pi * 0.3 * t)  # Hz
+    phase = 2 * np.pi * np.cumsum(pitch) / sampling_rate
+    audio = sum(np.sin(k * phase) / k for k in range(1, 8))
+    syllables = 0.5 + 0.5 * np.sin(2 * np.pi * 4 * t)
+    audio = audio * syllables + 0.05 * np.random.default_rng(seed).standard_normal(n)
+    return (0.2 * audio / np.abs(audio).max()).astype(np.float32)
+
+
+def warmup_online(online, lengths=WARMUP_LENGTHS, vac_chunk_size=0.04):
+    '''Runs the online processor on synthetic audio of every length in seconds: one update with the whole audio, and
+    the finishing of the segment. With VAC (VACOnlineASRProcessor), the VAD and the VAC finish are warmed up with the
+    first length in chunks of vac_chunk_size, and the wrapped processor with all lengths, because the VAD may not
+    find any voice in the synthetic audio. The processor is initialized for a new session at the end.'''
+    if hasattr(online, "vac"):
+        audio = synthetic_audio(lengths[0])
+        chunk = int(vac_chunk_size * SAMPLING_RATE)
+        start = time.time()
+        online.init()
+        for beg in range(0, len(audio), chunk):
+            online.insert_audio_chunk(audio[beg:beg + chunk])
+            online.process_iter()
+        online.finish()
+        logger.info(f"Warm-up of VAC with {lengths[0]} s of synthetic audio: {time.time() - start:.2f} s")
+        warmup_online(online.online, lengths)
+        online.init()
+        return
+
+    for seconds in lengths:
+        start = time.time()
+        online.init()
+        online.insert_audio_chunk(synthetic_audio(seconds))
+        online.process_iter()
+        online.finish()
+        logger.info(f"Warm-up with {seconds} s of synthetic audio: {time.time() - start:.2f} s")
+    online.init()
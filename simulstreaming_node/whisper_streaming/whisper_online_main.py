@@ -12,11 +12,19 @@ from functools import lru_cache
 import time
 import logging
 
+from whisper_streaming.vad_backends import VAD_BACKENDS
+
 
 logger = logging.getLogger(__name__)
 
 @lru_cache(10**6)
 def load_audio(fname):
+    # a 16kHz mono file is read directly by soundfile. librosa imports scipy and numba on the first use, which takes
+    # seconds, so it's used only when the audio has to be resampled or mixed to mono.
+    import soundfile
+    a, sr = soundfile.read(fname, dtype=np.float32, always_2d=True)
+    if sr == 16000 and a.shape[1] == 1:
+        return a[:, 0]
     a, _ = librosa.load(fname, sr=16000, dtype=np.float32)
     return a
 
@@ -45,6 +53,16 @@ def processor_args(parser):
                         help='Use VAC = voice activity controller. Recommended. Requires torch.')
     group.add_argument('--vac-chunk-size', type=float, default=0.04, 
                         help='VAC sample size in seconds.')
+    group.add_argument('--vac-backend', type=str, default="silero", choices=list(VAD_BACKENDS),
+                        help='VAD model of VAC. silero: TorchScript model from --vac-model-path, or from torch.hub if not set. '
+                        'silero-onnx: ONNX model from --vac-model-path, requires onnxruntime. '
+                        'energy: energy and zero-crossing rate, the lowest CPU cost but the least robust to noise.')
+    group.add_argument('--vac-model-path', type=str, default=None,
+                        help='Path to a local VAD model file for --vac-backend, e.g. silero_vad.jit or silero_vad.onnx. '
+                        'With a local file, no network access is needed.')
+    group.add_argument('--vac-batched', action="store_true", default=False,
+                        help='Evaluate the VAD of all sessions in this process in batches, with one shared model. '
+                        'It saves CPU with many concurrent sessions.')
     group.add_argument('--vad', action="store_true", default=False, 
                         help='Use VAD = voice activity detection, with the default parameters.')
 
@@ -68,7 +86,8 @@ def asr_factory(args, factory=None):
     # Create the OnlineASRProcessor
     if args.vac:
         from whisper_streaming.vac_online_processor import VACOnlineASRProcessor
-        online = VACOnlineASRProcessor(args.min_chunk_size, online)
+        online = VACOnlineASRProcessor(args.min_chunk_size, online, vad_backend=args.vac_backend,
+                                       vad_model_path=args.vac_model_path, batched_vad=args.vac_batched)
 
     if args.task == "translate":
         if args.model_path.endswith(".en.pt"):
@@ -95,6 +114,19 @@ def simulation_args(parser):
     # TODO: offline mode is not implemented in SimulStreaming yet
 #    simulation_group.add_argument('--offline', action="store_true", default=False, help='Offline mode.')
     simulation_group.add_argument('--comp_unaware', action="store_true", default=False, help='Computationally unaware simulation.')
+    simulation_group.add_argument('--vad-index', type=str, default=None,
+                        help='VAD index of the audio file made by vad_indexer.py, or "auto" for the default path next to the '
+                        'audio file. Only the speech segments in the index are processed, like with --vac, without running the VAD.')
+
+def indexed_vac_processor(args, online):
+    '''Wraps the online processor with IndexedVACOnlineASRProcessor, with the segments of args.vad_index.'''
+    from whisper_streaming.vac_online_processor import IndexedVACOnlineASRProcessor
+    from whisper_streaming.vad_index import default_index_path, read_vad_index
+    index_path = default_index_path(args.audio_path) if args.vad_index == "auto" else args.vad_index
+    segments = read_vad_index(index_path, num_samples=len(load_audio(args.audio_path)))
+    logger.info(f"VAD index {index_path}: {len(segments)} speech segments")
+    return IndexedVACOnlineASRProcessor(args.min_chunk_size, online, segments,
+                                        start=int(getattr(args, "start_at", 0)*16000))
 
 def main_simulation_from_file(factory, add_args=None):
     '''
@@ -132,6 +164,11 @@ def main_simulation_from_file(factory, add_args=None):
         min_chunk = args.vac_chunk_size
     else:
         min_chunk = args.min_chunk_size
+    if args.vad_index is not None:
+        if args.vac:
+            logger.error("Only one of --vac and --vad-index can be used. Exiting.")
+            sys.exit(1)
+        online = indexed_vac_processor(args, online)
 
     # load the audio into the LRU cache before we start the timer
     a = load_audio_chunk(audio_path,0,1)
@@ -5,6 +5,9 @@ import sys
 import argparse
 import os
 import logging
+import time
+import select
+import threading
 import numpy as np
 
 logger = logging.getLogger(__name__)
@@ -45,43 +48,140 @@ class Connection:
         except ConnectionResetError:
             return None
 
-import io
-import soundfile
+from whisper_streaming.pcm_input import PCMReceiver
+from whisper_streaming.warmup import warmup_online, WARMUP_LENGTHS
+from whisper_streaming import metrics
+from whisper_streaming.live_profiler import LiveProfiler
+
+# the lines of the concurrent sessions are printed whole
+stdout_lock = threading.Lock()
 
 # wraps socket and ASR object, and serves one client connection. 
 # next client should be served by a new instance of this object
+#
+# The audio is received by a reader thread, which drains the socket into the ring buffer of the receiver all the time,
+# also while the model is running. With VAC, the VAD runs in the reader thread too. The thread of process() runs the
+# inference, and when it wakes up, it takes all the audio that has arrived since the last update.
 class ServerProcessor:
 
-    def __init__(self, c, online_asr_proc, min_chunk):
+    # seconds, how often the reader thread checks whether the session has ended
+    POLL_INTERVAL = 0.5
+
+    def __init__(self, c, online_asr_proc, min_chunk, input_sampling_rate=SAMPLING_RATE, send_to_client=False):
         self.connection = c
         self.online_asr_proc = online_asr_proc
         self.min_chunk = min_chunk
+        self.send_to_client = send_to_client
 
         self.last_end = None
 
         self.is_first = True
 
+        # the ring buffer must hold at least the minimal chunk and one received packet
+        self.receiver = PCMReceiver(c.conn, SAMPLING_RATE, input_sampling_rate, capacity_seconds=max(30, 4*min_chunk))
+        # the VAD of VACOnlineASRProcessor, it runs in the reader thread
+        self.vad = getattr(online_asr_proc, "vac", None)
+
+        # shared by the reader and the inference thread, under self.condition
+        self.condition = threading.Condition()
+        self.vad_chunks = []  # (audio, VAD result) that are not inserted yet, if self.vad
+        self.vad_chunks_len = 0
+        self.closed = False  # no more audio
+        self.stopped = False  # the session ended, the reader stops
+        self.pending_since = None  # when the oldest audio that is not inserted yet was received
+
+        # the audio backlog at the last update, and the max one in the session
+        self.queue_seconds = 0.0
+        self.lag_seconds = 0.0
+        self.max_queue_seconds = 0.0
+        self.max_lag_seconds = 0.0
+
+    def queued_samples(self):
+        return len(self.receiver) + self.vad_chunks_len
+
+    def receive_loop(self):
+        '''The reader thread. It receives the audio until the connection is closed or the session ends.'''
+        conn = self.receiver.conn
+        try:
+            while not self.stopped:
+                readable, _, _ = select.select([conn], [], [], self.POLL_INTERVAL)
+                if not readable:
+                    continue
+                with self.condition:
+                    while self.queued_samples() >= self.receiver.ring.capacity and not self.stopped:
+                        # the inference is more than the whole ring behind, the backlog waits in the kernel buffer.
+                        # With VAC, the audio is moved to self.vad_chunks, so they are bounded the same way.
+                        self.condition.wait()
+                    if self.stopped:
+                        break
+                    received = self.receiver.receive(block=False)
+                    if self.receiver.closed:
+                        break
+                    if not received:
+                        continue
+                    received_at = time.monotonic()
+                    if self.vad is None:
+                        if self.pending_since is None:
+                            self.pending_since = received_at
+                        self.condition.notify()
+                        continue
+                    audio = self.receiver.read()
+                    if len(audio) == 0:
+                        # only an odd byte was received
+                        continue
+                res = self.vad(audio)
+                with self.condition:
+                    self.vad_chunks.append((audio, res))
+                    self.vad_chunks_len += len(audio)
+                    if self.pending_since is None:
+                        self.pending_since = received_at
+                    self.condition.notify()
+        except (OSError, ValueError) as e:
+            # e.g. the socket is closed by the other side or after the session
+            logger.debug(f"Receiving audio stopped: {e}")
+        finally:
+            with self.condition:
+                # the rest of the resampled audio is flushed to the ring
+                self.receiver.close()
+                if len(self.receiver) > 0 and self.pending_since is None:
+                    self.pending_since = time.monotonic()
+                if self.vad is not None and len(self.receiver) > 0:
+                    audio = self.receiver.read()
+                    self.vad_chunks.append((audio, self.vad(audio)))
+                    self.vad_chunks_len += len(audio)
+                self.closed = True
+                self.condition.notify()
+
     def receive_audio_chunk(self):
-        # receive all audio that is available by this time
+        # takes all audio that is available by this time, as a list of (audio, VAD result or None)
         # blocks operation if less than self.min_chunk seconds is available
         # unblocks if connection is closed or a chunk is available
-        out = []
         minlimit = self.min_chunk*SAMPLING_RATE
-        while sum(len(x) for x in out) < minlimit:
-            raw_bytes = self.connection.non_blocking_receive_audio()
-            if not raw_bytes:
-                break
-#            print("received audio:",len(raw_bytes), "bytes", raw_bytes[:10])
-            sf = soundfile.SoundFile(io.BytesIO(raw_bytes), channels=1,endian="LITTLE",samplerate=SAMPLING_RATE, subtype="PCM_16",format="RAW")
-            audio, _ = librosa.load(sf,sr=SAMPLING_RATE,dtype=np.float32)
-            out.append(audio)
-        if not out:
-            return None
-        conc = np.concatenate(out)
-        if self.is_first and len(conc) < minlimit:
-            return None
-        self.is_first = False
-        return np.concatenate(out)
+        with self.condition:
+            while self.queued_samples() < minlimit and not self.closed:
+                self.condition.wait()
+            n = self.queued_samples()
+            if n == 0:
+                return None
+            if self.is_first and n < minlimit:
+                return None
+            self.is_first = False
+
+            self.queue_seconds = n / SAMPLING_RATE
+            self.lag_seconds = time.monotonic() - self.pending_since
+            self.max_queue_seconds = max(self.max_queue_seconds, self.queue_seconds)
+            self.max_lag_seconds = max(self.max_lag_seconds, self.lag_seconds)
+            self.pending_since = None
+            if self.vad is not None:
+                chunks = self.vad_chunks
+                self.vad_chunks = []
+                self.vad_chunks_len = 0
+            else:
+                chunks = [(self.receiver.read(), None)]
+            # the reader can receive again
+            self.condition.notify()
+        logger.debug(f"Audio queue: {self.queue_seconds:.2f} s in {len(chunks)} chunks, lag {self.lag_seconds:.2f} s")
+        return chunks
 
     def format_output_transcript(self,o):
         # output format in stdout is like:
@@ -107,24 +207,60 @@ class ServerProcessor:
             return None
 
     def send_result(self, o):
-        msg = self.format_output_transcript(o)
-        if msg is not None:
-            print(msg, flush=True)
+        with metrics.stage_seconds.time(stage="output"):
+            msg = self.format_output_transcript(o)
+            if msg is None:
+                return
+            if self.send_to_client:
+                self.connection.send(msg)
+            else:
+                with stdout_lock:
+                    print(msg, flush=True)
+
+    def update_metrics(self, seconds, audio_seconds):
+        metrics.update_seconds.observe(seconds)
+        metrics.processing_seconds.inc(seconds)
+        metrics.audio_seconds.inc(audio_seconds)
+        if audio_seconds > 0:
+            metrics.update_rtf.observe(seconds / audio_seconds)
+        metrics.audio_lag_seconds.observe(self.lag_seconds)
+        metrics.queued_audio_seconds.set(self.queue_seconds)
 
     def process(self):
         # handle one client connection
         self.online_asr_proc.init()
-        while True:
-            a = self.receive_audio_chunk()
-            if a is None:
-                break
-            self.online_asr_proc.insert_audio_chunk(a)
-            o = self.online_asr_proc.process_iter()
-            try:
-                self.send_result(o)
-            except BrokenPipeError:
-                logger.info("broken pipe -- connection closed?")
-                break
+        metrics.sessions.inc()
+        reader = threading.Thread(target=self.receive_loop, daemon=True, name=f"{threading.current_thread().name} reader")
+        reader.start()
+        try:
+            while True:
+                chunks = self.receive_audio_chunk()
+                if chunks is None:
+                    break
+                start = time.perf_counter()
+                try:
+                    for a, vad_result in chunks:
+                        if self.vad is None:
+                            self.online_asr_proc.insert_audio_chunk(a)
+                            continue
+                        self.online_asr_proc.insert_vad_result(a, vad_result)
+                        if self.online_asr_proc.is_currently_final:
+                            # the end of voice is processed before the audio after it
+                            self.send_result(self.online_asr_proc.process_iter())
+                    o = self.online_asr_proc.process_iter()
+                    self.send_result(o)
+                except BrokenPipeError:
+                    logger.info("broken pipe -- connection closed?")
+                    break
+                self.update_metrics(time.perf_counter() - start, self.queue_seconds)
+        finally:
+            with self.condition:
+                self.stopped = True
+                self.condition.notify_all()
+            reader.join()
+            self.online_asr_proc.close()
+            metrics.sessions.inc(-1)
+            logger.info(f"Audio backlog of the session: max {self.max_queue_seconds:.2f} s, max lag {self.max_lag_seconds:.2f} s")
 
 #        o = online.finish()  # this should be working
 #        self.send_result(o)
@@ -141,9 +277,29 @@ def main_server(factory, add_args):
     # server options
     parser.add_argument("--host", type=str, default='localhost')
     parser.add_argument("--port", type=int, default=43007)
+    parser.add_argument("--max-sessions", type=int, default=1, dest="max_sessions",
+            help="Number of client connections that are served concurrently. Every session has its own decoding state, the model "
+            "is loaded once and the sessions decode one after another. More clients wait until a session ends.")
+    parser.add_argument("--send-to-client", action="store_true", default=False, dest="send_to_client",
+            help="Send the transcript lines back to the client over its connection, instead of printing them to stdout, where "
+            "the lines of all concurrent sessions are mixed.")
+    parser.add_argument("--input-sampling-rate", type=int, default=SAMPLING_RATE, dest="input_sampling_rate",
+            help="Sampling rate of the 16-bit mono PCM that the clients send. If it differs from 16000, the audio is resampled.")
+    parser.add_argument("--metrics-port", type=int, default=None, dest="metrics_port",
+            help="Serve the latency metrics of the processing stages, the real-time factor, the audio lag and the decoding stops "
+            "on http://localhost:METRICS_PORT/metrics, in the Prometheus text format.")
+    parser.add_argument("--profile-dir", type=str, default=".", dest="profile_dir",
+            help="Directory of the profiles of the live server. A profile is captured on SIGUSR1, e.g. kill -USR1 <pid>, without "
+            "interrupting the sessions.")
+    parser.add_argument("--profile-seconds", type=float, default=20, dest="profile_seconds",
+            help="Length of a live profile capture in seconds.")
     parser.add_argument("--warmup-file", type=str, dest="warmup_file", 
             help="The path to a speech audio wav file to warm up Whisper so that the very first chunk processing is fast. It can be e.g. "
-            "https://github.com/ggerganov/whisper.cpp/raw/master/samples/jfk.wav .")
+            "https://github.com/ggerganov/whisper.cpp/raw/master/samples/jfk.wav . Without it, Whisper is warmed up with "
+            "synthetic audio, see --warmup-lengths.")
+    parser.add_argument("--warmup-lengths", type=float, nargs="*", default=WARMUP_LENGTHS, dest="warmup_lengths",
+            help="Lengths in seconds of the synthetic audio that warms up Whisper and VAC before the server starts listening, "
+            "so that the first requests are as fast as the next ones. Without any values, there is no warm-up.")
 
     # options from whisper_online
     processor_args(parser)
@@ -154,6 +310,8 @@ def main_server(factory, add_args):
 
     set_logging(args,logger)
 
+    LiveProfiler(args.profile_dir, args.profile_seconds).install()
+
     # setting whisper object by args 
 
 
@@ -174,21 +332,51 @@ def main_server(factory, add_args):
         else:
             logger.critical("The warm up file is not available. "+msg)
             sys.exit(1)
+    elif args.warmup_lengths:
+        warmup_online(online, args.warmup_lengths, min_chunk)
+        logger.info("Whisper is warmed up.")
     else:
         logger.warning(msg)
+    # idle until the first session
+    online.close()
+
+    # the warm-up is not counted
+    metrics.reset()
+    if args.metrics_port is not None:
+        metrics.serve_metrics("localhost", args.metrics_port)
 
     # server loop
 
+    # online processors of the ended sessions, reused by the next ones. There are at most max_sessions of them.
+    idle = [online]
+    idle_lock = threading.Lock()
+    free_slots = threading.Semaphore(args.max_sessions)
+
+    def serve(conn, addr):
+        with idle_lock:
+            online = idle.pop() if idle else None
+        try:
+            if online is None:
+                # the model is shared, only a new decoding state is created
+                _, online = asr_factory(args, factory)
+            connection = Connection(conn)
+            proc = ServerProcessor(connection, online, min_chunk, args.input_sampling_rate, args.send_to_client)
+            proc.process()
+        finally:
+            conn.close()
+            logger.info('Connection to client {} closed'.format(addr))
+            if online is not None:
+                with idle_lock:
+                    idle.append(online)
+            free_slots.release()
+
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
         s.bind((args.host, args.port))
-        s.listen(1)
+        s.listen(args.max_sessions)
         logger.info('Listening on'+str((args.host, args.port)))
         while True:
+            free_slots.acquire()
             conn, addr = s.accept()
             logger.info('Connected to client on {}'.format(addr))
-            connection = Connection(conn)
-            proc = ServerProcessor(connection, online, min_chunk)
-            proc.process()
-            conn.close()
-            logger.info('Connection to client closed')
-    logger.info('Connection closed, terminating.')
\ No newline at end of file
+            threading.Thread(target=serve, args=(conn, addr), daemon=True, name=f"session {addr}").start()
+    logger.info('Connection closed, terminating.')